@@ -0,0 +1,143 @@
+"""Benchmarks for util.
+
+Run all benchmarks with:
+
+    python bench_util.py
+
+or a selection of them by name:
+
+    python bench_util.py locator_edit
+
+"""
+import fnmatch
+import os
+import py_compile
+import statistics
+import subprocess
+import sys
+import time
+
+import util
+
+BENCHMARKS = {}
+
+
+def benchmark(fn):
+    """Register `fn` as a benchmark, named without its bench_ prefix."""
+    BENCHMARKS[fn.__name__[len('bench_'):]] = fn
+    return fn
+
+
+def timed(fn, *args):
+    """Return the wall-clock time in seconds of calling fn(*args)."""
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def report(name, seconds, count=1):
+    print("  {:<40} {:10.3f} ms".format(name, 1000 * seconds / count))
+
+
+@benchmark
+def bench_locator_edit():
+    """Per-keystroke cost of EditableLocator.apply_edit() compared to
+    rebuilding a Locator, on a file of 1,000,000 lines.
+
+    """
+    data = "    value = compute(value, other_value)  # comment\n" * 1000000
+    locator = util.EditableLocator(data)
+    middle = len(data) // 2
+    edits = 1000
+
+    def type_chars():
+        for idx in range(edits):
+            locator.apply_edit(middle + idx, middle + idx, "\n" if idx % 40 == 0 else "x")
+            locator.locate(middle)
+
+    report("EditableLocator.apply_edit + locate", timed(type_chars), edits)
+    report("Locator rebuild", timed(util.Locator, data))
+
+
+@benchmark
+def bench_file_list_exclude():
+    """file_list() with excluded directories pruned, compared to filtering
+    its output with fnmatch, on a tree where most files are below
+    node_modules and .git directories.
+
+    """
+    with util.tempdir() as root:
+        for top, num_dirs, num_files in (('src', 10, 20), ('node_modules', 200, 50), ('.git', 100, 50)):
+            for dir_idx in range(num_dirs):
+                path = os.path.join(root, top, str(dir_idx))
+                os.makedirs(path)
+                for file_idx in range(num_files):
+                    util.touch(os.path.join(path, '{}.js'.format(file_idx)))
+
+        def filtered():
+            return [path for path in util.file_list(root)
+                    if not fnmatch.fnmatch(path, 'node_modules/*') and not fnmatch.fnmatch(path, '.git/*')]
+
+        def pruned():
+            return list(util.file_list(root, exclude=['node_modules/', '.git/']))
+
+        assert filtered() == pruned()
+        report("file_list + fnmatch filter", timed(filtered))
+        report("file_list(exclude=...)", timed(pruned))
+
+
+@benchmark
+def bench_convert_keys():
+    """Converting the keys of a JSON-like payload of 10,000 records, each
+    with nested objects and lists, to CamelCase and back, with camelify()
+    and snakify() compared to a KeyCaseCodec.
+
+    """
+    payload = [{
+        'record_id': idx,
+        'created_at': '2024-01-01T00:00:00Z',
+        'owner_user': {'user_id': idx % 100, 'display_name': 'user', 'email_address': 'user@example.com'},
+        'line_items': [{'item_id': item, 'unit_price': 1.5, 'tax_rate': 0.2, 'product_code': 'X'}
+                       for item in range(5)],
+        'shipping_address': {'street_line_1': '1 Road', 'postal_code': '0000', 'country_code': 'NZ'},
+        'is_active': True,
+    } for idx in range(10000)]
+
+    def uncached():
+        util.convert_keys(util.convert_keys(payload, util.camelify), util.snakify)
+
+    def cached():
+        codec = util.KeyCaseCodec()
+        codec.to_snake(codec.to_camel(payload))
+
+    report("convert_keys with camelify/snakify", timed(uncached))
+    report("KeyCaseCodec to_camel/to_snake", timed(cached))
+
+
+@benchmark
+def bench_import_time():
+    """Time taken to import util, as reported by python -X importtime
+    (median of 20 runs, each in a new interpreter).
+
+    """
+    # Measure importing, not compiling, even if PYTHONDONTWRITEBYTECODE is set.
+    py_compile.compile(util.__file__)
+    times = []
+    for _ in range(20):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import util'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE, check=True)
+        for line in result.stderr.decode().splitlines():
+            if line.split('|')[-1].strip() == 'util':
+                times.append(int(line.split('|')[1]) / 1e6)
+    report("import util", statistics.median(times))
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(name)
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
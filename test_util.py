@@ -0,0 +1,862 @@
+import collections
+import concurrent.futures
+import contextlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import util
+from util import (BloomSeen, DirHandle, DuplicateFileFinder, EditableLocator, EnvOverlay, FileSnapshot, KeyCaseCodec,
+                  LRUSeen, Locator, PathMatcher, SpillingSeen, TempdirPool, async_yield_until_exception, camelify,
+                  chdir, configure_debug, convert_keys, debug, debug_dump, dict_inverse, dict_inverse_arrays, file_list,
+                  file_list_changes, find_duplicates_by_key, find_duplicates_by_key_external, frozendict, frozenmap,
+                  get_include_paths, group_by, grouped_indices, hash_join, probe_include_paths,
+                  remove_duplicates_by_key, run_parallel, show_exit, simplecontextmanager, snakify, split_inclusive,
+                  split_inclusive_iter, split_inclusive_views, tempdir, touch, tuple_gen, tuple_gen_nested,
+                  yield_until_exception_prefetch)
+
+
+class TestUtil(unittest.TestCase):
+
+    def test_import_time(self):
+        # Modules needed by only some functions must not be imported with util.
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import util'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE, check=True)
+        imported = {line.split('|')[-1].strip() for line in result.stderr.decode().splitlines()}
+        lazy = {'asyncio', 'concurrent.futures', 'hashlib', 'inspect', 'json', 'pickle', 'shutil', 'signal',
+                'subprocess', 'tempfile', 'threading', 'unittest'}
+        assert 'util' in imported
+        assert not lazy & imported, lazy & imported
+
+    def test_sig_names(self):
+        assert util.SIG_NAMES[9] == 'SIGKILL'
+
+    def test_chdir(self):
+        cur = os.getcwd()
+        with chdir('/'):
+            assert os.getcwd() == '/'
+        assert os.getcwd() == cur
+
+    def test_locator(self):
+        data = "ab\ncd\r\n\re\u2028f"
+        offsets = [0]
+        for line in data.splitlines(True):
+            offsets.append(offsets[-1] + len(line))
+        locator = Locator(data)
+        assert list(locator.line_offsets) == offsets
+        assert str(locator.locate(0)) == "<string>:1.0"
+        assert str(locator.locate(4)) == "<string>:2.1"
+        assert str(locator.locate(len(data))) == "<string>:6.0"
+
+    def test_locator_from_file(self):
+        data = b"ab\ncd\r\n\ref"
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            locator = Locator.from_file(f.name)
+            assert locator.name == f.name
+            assert list(locator.line_offsets) == list(Locator(data.decode()).line_offsets)
+            f.truncate(0)
+            assert list(Locator.from_file(f).line_offsets) == [0]
+
+    def test_locator_locate_many(self):
+        data = "ab\ncd\n\nefg"
+        locator = Locator(data)
+        offsets = [9, 0, 3, 2, 7, 11, 4]
+        lines, cols = locator.locate_many(offsets)
+        for offset, line, col in zip(offsets, lines, cols):
+            location = locator.locate(offset)
+            assert (location.line, location.col) == (line, col)
+
+    def test_locator_code_units(self):
+        data = "a\u00e9\U0001f600b\nc\u20acd"
+        with self.assertRaises(ValueError):
+            Locator(data).byte_offset(0)
+        locator = Locator(data, code_units=True)
+        assert locator.byte_offset(3) == 7
+        assert locator.code_point_offset(7) == 3
+        assert locator.utf16_location(4).col == 5
+        assert locator.offset_from_utf16(2, 2) == 7
+        byte_locator = Locator(data.encode(), code_units=True)
+        location = byte_locator.utf16_location(13)
+        assert (location.line, location.col) == (2, 2)
+        assert byte_locator.offset_from_utf16(1, 5) == 8
+        try:
+            locator.code_point_offset(2)
+        except ValueError:
+            pass
+        else:
+            assert False
+
+    def test_editable_locator(self):
+        data = "ab\ncd\nef"
+        locator = EditableLocator(data)
+        for start, end, new_text in [(1, 1, "x\ny"), (0, 4, ""), (3, 7, "\n\n"), (5, 5, "gh\n")]:
+            locator.apply_edit(start, end, new_text)
+            data = data[:start] + new_text + data[end:]
+            expected = Locator(data)
+            assert list(locator.line_offsets) == list(expected.line_offsets)
+            for offset in range(len(data) + 2):
+                assert str(locator.locate(offset)) == str(expected.locate(offset))
+
+    def test_editable_locator_code_units(self):
+        import random
+        rand = random.Random(3)
+        alphabet = ['a', 'b', '\n', '\r\n', '\u00e9', '\u20ac', '\U0001f600', '\x85', '\u2028']
+
+        class SmallBlockLocator(EditableLocator):
+            _BLOCK_SIZE = 2
+
+        for byte_units in (False, True):
+            data = "a\u00e9\U0001f600b\nc\u20acd\n\u00e9\x85\u00e9\n" * 4
+            if byte_units:
+                data = "a\u00e9\U0001f600b\nc\u20acd\n" * 4
+            locator = SmallBlockLocator(data.encode() if byte_units else data)
+            for _ in range(100):
+                start = rand.randrange(len(data) + 1)
+                end = rand.randrange(start, min(start + 5, len(data)) + 1)
+                new_text = ''.join(rand.choice(alphabet[:6] if byte_units else alphabet)
+                                   for _ in range(rand.randrange(4)))
+                if byte_units:
+                    # The edit must not split a '\r\n' pair.
+                    if data[start - 1:start + 1] == '\r\n' or data[end - 1:end + 1] == '\r\n':
+                        continue
+                    encoded_start = len(data[:start].encode())
+                    locator.apply_edit(encoded_start, encoded_start + len(data[start:end].encode()), new_text.encode())
+                else:
+                    if '\r' in data[start - 1:start + 1] or '\r' in data[end - 1:end + 1]:
+                        continue
+                    locator.apply_edit(start, end, new_text)
+                data = data[:start] + new_text + data[end:]
+                text = data.encode() if byte_units else data
+                expected = Locator(text, code_units=True)
+                for offset in range(len(data) + 1):
+                    encoded = len(data[:offset].encode())
+                    assert locator.byte_offset(offset) == expected.byte_offset(offset) == encoded
+                    assert locator.code_point_offset(encoded) == offset
+                    native = encoded if byte_units else offset
+                    location = locator.utf16_location(native)
+                    expected_location = expected.utf16_location(native)
+                    assert (location.line, location.col) == (expected_location.line, expected_location.col)
+                    assert locator.offset_from_utf16(location.line, location.col) == native
+
+    def test_locator_from_file_code_units(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write("a\u00e9\nb\U0001f600c".encode() * 3)
+            f.flush()
+            with self.assertRaises(ValueError):
+                Locator.from_file(f.name).byte_offset(0)
+            locator = Locator.from_file(f.name, code_units=True)
+            assert locator.code_point_offset(10) == 6
+            assert locator.utf16_location(10).col == 4
+            for code_units in (False, True):
+                assert EditableLocator.from_file(f.name, code_units=code_units).code_point_offset(10) == 6
+
+    def test_dir_handle(self):
+        cwd = os.getcwd()
+        with tempdir() as t:
+            def work(name):
+                with DirHandle(t) as d:
+                    d.mkdir(name)
+                    with d.subdir(name) as sub:
+                        with sub.open('a', 'w') as f:
+                            f.write(name)
+                        sub.rename('a', 'b')
+                        assert sub.listdir() == ['b']
+                        assert [entry.name for entry in sub.scandir()] == ['b']
+                        assert sub.stat('b').st_size == len(name)
+                        assert not sub.exists('a')
+                        sub.unlink('b')
+                    d.rmdir(name)
+
+            with concurrent.futures.ThreadPoolExecutor(8) as executor:
+                list(executor.map(work, map(str, range(8))))
+            assert os.listdir(t) == []
+        assert os.getcwd() == cwd
+
+    def test_dict_inverse(self):
+        assert dict_inverse({1: 'a', 2: 'a', 3: 'c'}) == {'a': [1, 2], 'c': [3]}
+        assert dict_inverse({1: 'a', 2: 'b', 3: 'c'}, True) == {'a': 1, 'b': 2, 'c': 3}
+
+    def test_grouped_indices(self):
+        unique_keys, offsets, indices = grouped_indices([3, 1, 3, 2, 1])
+        assert list(unique_keys) == [1, 2, 3]
+        assert list(offsets) == [0, 2, 3, 5]
+        assert list(indices) == [1, 4, 3, 0, 2]
+        unique_values, offsets, keys = dict_inverse_arrays([10, 20, 30], [7, 7, 9])
+        assert list(unique_values) == [7, 9]
+        assert list(offsets) == [0, 2, 3]
+        assert list(keys) == [10, 20, 30]
+
+    def test_simplecontextmanager(self):
+        before = None
+        after = None
+
+        @simplecontextmanager
+        def foo():
+            nonlocal before
+            nonlocal after
+            after = None
+            before = True
+            yield 1
+            after = True
+
+        with foo() as x:
+            assert x == 1
+            assert before
+            assert after is None
+        assert before
+        assert after
+
+        try:
+            with foo() as x:
+                assert x == 1
+                assert before
+                assert after is None
+                raise Exception('check')
+        except Exception as exc:
+            assert exc.args == ('check', )
+            assert before
+            assert after
+        else:
+            assert False
+
+    def test_simplecontextmanager_double_yield(self):
+        before = None
+        after = None
+
+        @simplecontextmanager
+        def foo():
+            nonlocal before
+            nonlocal after
+            after = None
+            before = True
+            yield 1
+            yield 2
+            after = True
+
+        try:
+            with foo() as x:
+                assert x == 1
+                assert before
+                assert after is None
+        except RuntimeError as exc:
+            assert exc.args == ("generator didn't stop", )
+        else:
+            assert False
+
+    def test_simplecontextmanager_raise(self):
+        before = None
+        after = None
+
+        @simplecontextmanager
+        def foo():
+            nonlocal before
+            nonlocal after
+            after = None
+            before = True
+            yield 1
+            raise Exception("with")
+
+        try:
+            with foo() as x:
+                assert x == 1
+                assert before
+                assert after is None
+        except Exception as exc:
+            assert exc.args == ('with', )
+            assert before
+            assert after is None
+        else:
+            assert False
+
+        try:
+            with foo() as x:
+                assert x == 1
+                assert before
+                assert after is None
+                raise Exception("check")
+        except Exception as exc:
+            assert exc.args == ('check', )
+            assert before
+            assert after is None
+        else:
+            assert False
+
+    def test_tempdir(self):
+        tempdir_name = None
+        with tempdir() as t:
+            tempdir_name = t
+            assert os.path.exists(tempdir_name)
+
+        assert not os.path.exists(tempdir_name)
+
+        try:
+            with tempdir() as t:
+                tempdir_name = t
+                assert os.path.exists(tempdir_name)
+                raise Exception('tempdir_with_fail')
+        except Exception as exc:
+            assert exc.args == ('tempdir_with_fail', )
+        else:
+            assert False
+
+        assert not os.path.exists(tempdir_name)
+
+    def test_env_overlay(self):
+        environ = dict(os.environ)
+        base = EnvOverlay({'PYUTIL_A': '1', 'PYUTIL_B': '2'})
+        overlay = base.overlay({'PYUTIL_B': None, 'PYUTIL_C': '3'})
+        assert base['PYUTIL_B'] == '2'
+        assert 'PYUTIL_B' not in overlay
+        assert overlay['PYUTIL_A'] == '1'
+        assert overlay.environ is overlay.environ
+        output = overlay.run(['sh', '-c', 'echo $PYUTIL_A$PYUTIL_B$PYUTIL_C'], stdout=subprocess.PIPE).stdout
+        assert output == b'13\n'
+        assert dict(os.environ) == environ
+
+    def test_tempdir_pool(self):
+        with TempdirPool(max_dirty=1) as pool:
+            for _ in range(3):
+                with tempdir(pool) as t:
+                    assert os.listdir(t) == []
+                    os.mkdir(os.path.join(t, 'sub'))
+                    touch(os.path.join(t, 'sub', 'file'))
+                    os.symlink('/', os.path.join(t, 'link'))
+                    tempdir_name = t
+            assert pool.created + pool.reused == 3
+            assert pool.created <= 2
+        assert not os.path.exists(tempdir_name)
+
+        # Closing the pool while a directory is in use.
+        pool = TempdirPool()
+        with tempdir(pool) as t:
+            touch(os.path.join(t, 'file'))
+            pool.close()
+        assert not os.path.exists(t)
+        assert pool._dirty == 0
+
+        try:
+            TempdirPool(max_dirty=0)
+        except ValueError:
+            pass
+        else:
+            assert False
+
+    def test_file_list(self):
+        with tempdir() as t:
+            touch(os.path.join(t, 'b'))
+            touch(os.path.join(t, 'a'))
+            os.mkdir(os.path.join(t, 'c'))
+            touch(os.path.join(t, 'c', '1'))
+            assert list(file_list(t)) == ['a', 'b', 'c/1']
+
+    def test_path_matcher(self):
+        matcher = PathMatcher(['# comment', '', '*.o', '/build', 'docs/*.txt', 'cache/', 'a/**/z', '[!x]y'])
+        assert matcher.match('main.o')
+        assert matcher.match('src/main.o')
+        assert not matcher.match('main.c')
+        assert matcher.match('build', True)
+        assert matcher.match('build/out/main.c')
+        assert not matcher.match('src/build/main.c')
+        assert matcher.match('docs/readme.txt')
+        assert not matcher.match('docs/sub/readme.txt')
+        assert matcher.match('src/cache', True)
+        assert matcher.match('src/cache/file')
+        assert not matcher.match('src/cache')
+        assert matcher.match('a/z')
+        assert matcher.match('a/b/c/z')
+        assert matcher.match('ay')
+        assert not matcher.match('xy')
+
+    def test_file_list_patterns(self):
+        with tempdir() as t:
+            for d in ('src', 'node_modules', 'node_modules/pkg'):
+                os.mkdir(os.path.join(t, d))
+            for f in ('setup.py', 'src/a.py', 'src/a.pyc', 'src/b.txt', 'node_modules/pkg/c.py'):
+                touch(os.path.join(t, f))
+            for threads in (None, 2):
+                assert list(file_list(t, threads=threads, include=['*.py'], exclude=['node_modules/'])) == \
+                    ['setup.py', 'src/a.py']
+                assert list(file_list(t, threads=threads, exclude=PathMatcher(['*.pyc', 'node_modules']))) == \
+                    ['setup.py', 'src/a.py', 'src/b.txt']
+
+    def test_file_list_threads(self):
+        with tempdir() as t:
+            for d in ('b', 'a', 'a/y', 'a/x', 'c'):
+                os.mkdir(os.path.join(t, d))
+            for f in ('2', '1', 'a/1', 'a/y/1', 'a/x/2', 'a/x/1', 'c/1'):
+                touch(os.path.join(t, f))
+            os.symlink('a', os.path.join(t, 'link'))
+            expected = []
+            for base, dirs, files in os.walk(t):
+                dirs.sort()
+                expected.extend(os.path.relpath(os.path.join(base, f), t) for f in sorted(files))
+            assert list(file_list(t, threads=4)) == expected
+            assert list(file_list(t, threads=4, full_path=True)) == [os.path.join(t, p) for p in expected]
+            for path, entry in file_list(t, threads=4, entries=True):
+                assert entry.path == os.path.join(t, path)
+                assert entry.stat().st_size == 0
+
+        # Reading directories only runs a bounded distance ahead of the consumer.
+        with tempdir() as t:
+            for idx in range(300):
+                os.mkdir(os.path.join(t, str(idx)))
+                touch(os.path.join(t, str(idx), 'f'))
+            scanned = []
+            scan_dir = util._scan_dir
+            util._scan_dir = lambda path, sort, stat: scanned.append(stat) or scan_dir(path, sort, stat)
+            try:
+                files = file_list(t, threads=2)
+                assert len([next(files), next(files)]) == 2
+                time.sleep(0.2)
+                assert len(scanned) <= 2 * util._READ_AHEAD_PER_THREAD + 2
+                assert len(list(files)) == 298
+                files.close()
+                # Files are only stat()ed when their entries are wanted.
+                assert not any(scanned)
+                scanned.clear()
+                assert len(list(file_list(t, threads=2, entries=True))) == 300
+                assert all(scanned)
+            finally:
+                util._scan_dir = scan_dir
+
+    def test_file_list_changes(self):
+        with tempdir() as t:
+            os.mkdir(os.path.join(t, 'd'))
+            os.mkdir(os.path.join(t, 'e'))
+            for f in ('a', 'b', 'd/1', 'e/1'):
+                touch(os.path.join(t, f))
+            changes = file_list_changes(t)
+            assert changes.added == ['a', 'b', 'd/1', 'e/1']
+            assert changes.modified == changes.removed == []
+
+            snapshot_path = os.path.join(t, 'snapshot')
+            changes.snapshot.save(snapshot_path)
+            snapshot = FileSnapshot.load(snapshot_path)
+            assert snapshot.dirs == changes.snapshot.dirs
+            assert snapshot.files == changes.snapshot.files
+
+            with open(os.path.join(t, 'd', '1'), 'w') as f:
+                f.write('changed')
+            os.remove(os.path.join(t, 'b'))
+            shutil.rmtree(os.path.join(t, 'e'))
+            touch(os.path.join(t, 'd', '2'))
+            changes = file_list_changes(t, snapshot)
+            assert changes.added == ['snapshot', 'd/2']
+            assert changes.modified == ['d/1']
+            assert changes.removed == ['b', 'e/1']
+
+            changes = file_list_changes(t, changes.snapshot, trust_dir_mtime=True)
+            assert changes.added == changes.modified == changes.removed == []
+
+    def test_duplicate_file_finder(self):
+        with tempdir() as t:
+            contents = {'a': b'x' * 100, 'b': b'x' * 100, 'c': b'y' * 100, 'd': b'',
+                        'e': b'', 'f': b'z' * 5000, 'g': b'z' * 2500 + b'q' + b'z' * 2499,
+                        'h': b'z' * 5000}
+            for name, data in contents.items():
+                with open(os.path.join(t, name), 'wb') as f:
+                    f.write(data)
+            finder = DuplicateFileFinder(threads=2, block_size=1024)
+            duplicates = finder.find(t)
+            assert duplicates == [[os.path.join(t, name) for name in group] for group in ('ab', 'de', 'fh')]
+            assert finder.files == 8
+            assert finder.candidates == 8
+            assert finder.hashed == 3 + 3 + 3
+            assert finder.bytes_read == 3 * 100 + 3 * 2048 + 3 * 5000
+
+            # Counters are per find(), not cumulative.
+            assert finder.find(t) == duplicates
+            assert (finder.files, finder.candidates, finder.hashed) == (8, 8, 9)
+            assert finder.bytes_read == 3 * 100 + 3 * 2048 + 3 * 5000
+
+    def test_run_parallel(self):
+        commands = [['true'], ['sh', '-c', 'exit 3'], ['sh', '-c', 'kill -9 $$'], ['sleep', '0.1']]
+        results = list(run_parallel(commands, jobs=2))
+        assert sorted(result.index for result in results) == [0, 1, 2, 3]
+        exits = {result.index: result.exit for result in results}
+        assert exits == {0: "exit: 0", 1: "exit: 3", 2: "signal: SIGKILL", 3: "exit: 0"}
+        sleep_result = [result for result in results if result.index == 3][0]
+        assert sleep_result.args == ['sleep', '0.1']
+        assert sleep_result.wall_time >= 0.1
+        assert sleep_result.max_rss > 0
+
+        start = time.monotonic()
+        results = run_parallel([['sleep', '10'], ['true']], jobs=2)
+        assert next(results).args == ['true']
+        results.close()
+        assert time.monotonic() - start < 5
+
+        # A command that cannot be started is reported, and the others still run.
+        results = list(run_parallel([['sleep', '0.1'], ['no-such-command-xyz'], ['no-such-command-xyz'], ['true']],
+                                    jobs=2))
+        assert sorted(result.index for result in results) == [0, 1, 2, 3]
+        for result in results:
+            if result.args[0] == 'no-such-command-xyz':
+                assert isinstance(result.error, FileNotFoundError)
+                assert result.pid is None
+                assert os.waitstatus_to_exitcode(result.status) == 127
+                assert result.exit.startswith("error: ")
+            else:
+                assert result.error is None
+                assert result.exit == "exit: 0"
+
+    @unittest.skipIf(shutil.which('cc') is None, "no C compiler")
+    def test_probe_include_paths(self):
+        with tempdir() as cache_dir:
+            include_paths = get_include_paths('cc', cache_dir=cache_dir)
+            assert include_paths
+            assert probe_include_paths(['cc', 'cpp'], cache_dir=cache_dir)['cc'] == include_paths
+            cache_files = os.listdir(cache_dir)
+            assert len(cache_files) == 2
+
+            # A new process would read the results from the disk cache.
+            util._include_paths_cache.clear()
+            for name in cache_files:
+                with open(os.path.join(cache_dir, name), 'w') as f:
+                    f.write('{"include_paths": ["cached"]}')
+            assert get_include_paths('cc', cache_dir=cache_dir) == ['cached']
+            util._include_paths_cache.clear()
+
+            # Failing to write the disk cache doesn't fail the probe.
+            not_a_dir = os.path.join(cache_dir, 'file')
+            touch(not_a_dir)
+            assert get_include_paths('cc', cache_dir=os.path.join(not_a_dir, 'cache')) == include_paths
+            util._include_paths_cache.clear()
+
+    def test_debug(self):
+        x = 1
+        stream = io.StringIO()
+        try:
+            configure_debug(file=stream, ring_size=2)
+            for y in range(3):
+                debug("x={x} y={y} {{}}")
+            debug("no fields {{}}")
+            assert stream.getvalue() == "x=1 y=0 {}\nx=1 y=1 {}\nx=1 y=2 {}\nno fields {}\n"
+            dump = io.StringIO()
+            debug_dump(dump)
+            assert dump.getvalue() == "x=1 y=2 {}\nno fields {}\n"
+
+            configure_debug(enabled=False, file=stream)
+            debug("{undefined}")
+            assert stream.getvalue().count("\n") == 4
+        finally:
+            configure_debug()
+
+        # The crash hook is installed once and can be turned off again.
+        excepthook = sys.excepthook
+        hooked = []
+        sys.excepthook = lambda *args: hooked.append(args)
+        try:
+            configure_debug(quiet=True, ring_size=2, dump_on_crash=True)
+            configure_debug(quiet=True, ring_size=2, dump_on_crash=True)
+            debug("crash")
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                sys.excepthook(ValueError, ValueError(), None)
+                configure_debug(quiet=True, ring_size=2)
+                debug("no crash")
+                sys.excepthook(ValueError, ValueError(), None)
+            assert stderr.getvalue() == "crash\n"
+            assert len(hooked) == 2
+        finally:
+            sys.excepthook = excepthook
+            util._debug_next_excepthook = None
+            configure_debug()
+
+    def test_script(self):
+        with tempdir() as t:
+            script_path = os.path.join(t, 'script.py')
+            with open(script_path, 'w') as f:
+                f.write("import util\n"
+                        "def main():\n"
+                        "    data = [0] * 100000\n"
+                        "    return 3\n"
+                        "util.script()\n")
+            env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+            result = subprocess.run([sys.executable, script_path], env=env, stderr=subprocess.PIPE)
+            assert result.returncode == 3
+            assert result.stderr == b''
+
+            env['PYUTIL_PROFILE'] = 'time,tracemalloc,cprofile'
+            result = subprocess.run([sys.executable, script_path], env=env, stderr=subprocess.PIPE)
+            assert result.returncode == 3
+            stderr = result.stderr.decode()
+            assert "script: start-up: " in stderr
+            assert "script: peak traced memory: " in stderr
+            assert "script.py:2(main)" in stderr
+
+            env['PYUTIL_PROFILE_OUTPUT'] = os.path.join(t, 'stats')
+            result = subprocess.run([sys.executable, script_path], env=env, stderr=subprocess.PIPE)
+            assert "script.py:2(main)" not in result.stderr.decode()
+            assert os.path.exists(env['PYUTIL_PROFILE_OUTPUT'])
+
+    def test_group_by(self):
+        File = collections.namedtuple('File', 'name ext size')
+        files = [File('a', '.py', 100), File('b', '.c', 50), File('c', '.py', 200)]
+        assert group_by(files, {'ext': 'ext', 'big': lambda f: f.size > 60}) == {
+            'ext': {'.py': [files[0], files[2]], '.c': [files[1]]},
+            'big': {True: [files[0], files[2]], False: [files[1]]},
+        }
+        aggregates = {'n': 'count', 'size': ('sum', 'size'), 'smallest': ('min', 'size'), 'largest': ('max', 'size'),
+                      'first': ('first', 'name'), 'names': ('list', 'name')}
+        assert group_by(files, {'ext': 'ext'}, aggregates) == {
+            'ext': {
+                '.py': {'n': 2, 'size': 300, 'smallest': 100, 'largest': 200, 'first': 'a', 'names': ['a', 'c']},
+                '.c': {'n': 1, 'size': 50, 'smallest': 50, 'largest': 50, 'first': 'b', 'names': ['b']},
+            }
+        }
+
+    def test_find_duplicates_by_key_external(self):
+        records = [(i % 50, i) for i in range(300)] + [(1000, 0)]
+        expected = sorted(find_duplicates_by_key(records, lambda r: r[0]).items())
+        assert list(find_duplicates_by_key_external(records, lambda r: r[0])) == expected
+        # One record per run, so the runs are merged in several passes.
+        assert list(find_duplicates_by_key_external(records, lambda r: r[0], memory_limit=1)) == expected
+        assert list(find_duplicates_by_key_external(records, lambda r: r[0], memory_limit=1000)) == expected
+        assert list(find_duplicates_by_key_external([], lambda r: r)) == []
+
+    def test_frozendict(self):
+        d = frozendict({'a': 1, 'b': [2]})
+        assert d['b'] == [2]
+        with self.assertRaises(TypeError):
+            hash(d)
+        d = frozendict({'a': 1, 'b': 2})
+        assert hash(d) == hash(frozendict({'b': 2, 'a': 1}))
+        with self.assertRaises(AttributeError):
+            d['c'] = 3
+
+    def test_frozenmap(self):
+        import pickle
+        import random
+
+        class Colliding:
+            def __init__(self, value):
+                self.value = value
+
+            def __hash__(self):
+                return self.value % 3
+
+            def __eq__(self, other):
+                return isinstance(other, Colliding) and self.value == other.value
+
+            def __lt__(self, other):
+                return self.value < other.value
+
+            def __repr__(self):
+                return 'Colliding(%d)' % self.value
+
+        rand = random.Random(1)
+        keys = list(range(-50, 1000)) + ['k%d' % idx for idx in range(300)] + [Colliding(idx) for idx in range(20)]
+        m = frozenmap()
+        expected = {}
+        versions = []
+        for _ in range(5000):
+            key = rand.choice(keys)
+            if key in expected and rand.random() < 0.4:
+                m = m.delete(key)
+                del expected[key]
+            else:
+                m = m.set(key, rand.random())
+                expected[key] = m[key]
+            versions.append((m, dict(expected)))
+        for m, expected in versions[::250] + versions[-1:]:
+            assert len(m) == len(expected)
+            assert dict(m.items()) == expected
+            assert m == expected
+            assert sorted(m.values()) == sorted(expected.values())
+            assert all(m[k] == v for k, v in expected.items())
+
+        m = frozenmap({'a': 1}, b=2)
+        m2 = m.set('c', 3).update({'a': 10})
+        assert m == {'a': 1, 'b': 2} and m2 == {'a': 10, 'b': 2, 'c': 3}
+        assert m.set('a', 1) is m
+        assert 'c' not in m and m2.get('c') == 3
+        assert m2.delete('a').delete('b').delete('c') == frozenmap()
+        with self.assertRaises(KeyError):
+            m.delete('c')
+        assert hash(m) == hash(frozenmap(b=2, a=1))
+        assert pickle.loads(pickle.dumps(m2)) == m2
+        assert repr(frozenmap(a=1)) == "frozenmap({'a': 1})"
+
+        # A change copies only the path to the changed key.
+        big = frozenmap((idx, idx) for idx in range(10000))
+        changed = big.set(5, 'x')
+        assert changed[5] == 'x' and big[5] == 5
+        assert sum(a is b for a, b in zip(big._root.entries, changed._root.entries)) == len(big._root.entries) - 1
+
+    def test_split_inclusive(self):
+        items = [3, 1, 2, 3, 3, 4]
+        expected = list(split_inclusive(items, lambda v: v == 3))
+        assert expected == [[], [3, 1, 2], [3], [3, 4]]
+        assert list(split_inclusive_iter(iter(items), lambda v: v == 3)) == expected
+        assert list(split_inclusive_iter([], lambda v: True)) == [[]]
+
+        data = b'a\nbc\n\nd'
+        views = list(split_inclusive_views(data, lambda d: [b == ord('\n') for b in d]))
+        assert all(isinstance(view, memoryview) for view in views)
+        assert [bytes(view) for view in views] == [b'a', b'\nbc', b'\n', b'\nd']
+        views = list(split_inclusive_views(bytearray(b'\nab'), [True, False, True]))
+        assert [bytes(view) for view in views] == [b'', b'\na', b'b']
+
+    def test_hash_join(self):
+        Item = collections.namedtuple('Item', 'id name')
+        users = [Item(1, 'ann'), Item(2, 'bob'), Item(3, 'cy')]
+        orders = [Item(1, 'book'), Item(3, 'pen'), Item(1, 'cup'), Item(4, 'ink')]
+
+        def check(left, right, **kwargs):
+            # Without lengths `right` is indexed, keeping the order of `left`.
+            result = list(hash_join(iter(left), iter(right), 'id', **kwargs))
+            # The shorter `left` is indexed here, giving the same results in another order.
+            assert sorted(result) == sorted(hash_join(left, right, 'id', **kwargs))
+            return result
+
+        assert check(users, orders) == [(users[0], orders[0]), (users[0], orders[2]), (users[2], orders[1])]
+        assert check(users, orders, how='left') == [(users[0], orders[0]), (users[0], orders[2]),
+                                                    (users[1], None), (users[2], orders[1])]
+        assert check(users, orders, how='semi') == [users[0], users[2]]
+        assert check(users, orders, how='anti') == [users[1]]
+        assert check(users[:2], orders, how='left') == [(users[0], orders[0]), (users[0], orders[2]),
+                                                        (users[1], None)]
+        assert check(users[:2], orders, how='anti') == [users[1]]
+        assert list(hash_join(users, [1, 2], 'id', right_key=lambda v: v, how='semi')) == users[:2]
+        with self.assertRaises(ValueError):
+            hash_join(users, orders, 'id', how='outer')
+
+        Node = collections.namedtuple('Node', 'name children')
+        tree = Node('root', [Node('a', [Node('a1', []), Node('a2', [])]), Node('b', [])])
+        assert [tuple(n.name for n in t) for t in tuple_gen_nested(tree, 'children', 'children')] == [
+            ('a', 'a1'), ('a', 'a2')]
+        assert list(tuple_gen_nested(tree, 'children', 'children')) == list(tuple_gen(tree, 'children', 'children'))
+
+    def test_key_case_codec(self):
+        assert snakify('FooBarBaz') == 'foo_bar_baz'
+        assert snakify('HTTPServer2Url') == 'http_server2_url'
+        assert camelify(snakify('FooBar')) == 'FooBar'
+
+        codec = KeyCaseCodec()
+        payload = {'user_id': 1, 'tags': [{'tag_name': 'x', 2: 'y'}], 'nested': ({'ab_cd': None}, )}
+        camel = codec.to_camel(payload)
+        assert camel == {'UserId': 1, 'Tags': [{'TagName': 'x', 2: 'y'}], 'Nested': [{'AbCd': None}]}
+        assert codec.to_snake(camel) == convert_keys(payload, lambda k: k)
+
+        small_codec = KeyCaseCodec(maxsize=3)
+        assert small_codec.to_camel(payload) == camel
+        assert len(small_codec._camel) <= 3 and len(small_codec._snake) <= 3
+
+        # Earlier conversions don't change the results.
+        codec = KeyCaseCodec()
+        assert codec.snake('UserID') == 'user_id'
+        assert codec.camel('_id') == 'Id'
+        assert codec.to_camel({'user_id': 1}) == {'UserId': 1}
+        assert codec.to_snake({'Id': 1}) == {'id': 1}
+
+    def test_yield_until_exception_prefetch(self):
+        def reader(values, error=IndexError):
+            values = list(values)
+
+            def read():
+                if not values:
+                    raise error
+                return values.pop(0)
+            return read
+
+        assert list(yield_until_exception_prefetch(IndexError, reader(range(100)), prefetch=4)) == list(range(100))
+        assert list(yield_until_exception_prefetch(IndexError, reader(range(7)), batch=3)) == [
+            [0, 1, 2], [3, 4, 5], [6]]
+        assert list(yield_until_exception_prefetch(IndexError, reader([]), batch=3)) == []
+
+        values = []
+        with self.assertRaises(KeyError):
+            for value in yield_until_exception_prefetch(IndexError, reader(range(5), KeyError), batch=2):
+                values.append(value)
+        assert values == [[0, 1], [2, 3], [4]]
+
+        # Closing the generator early stops the thread.
+        calls = []
+
+        def count():
+            calls.append(None)
+            return len(calls)
+        gen = yield_until_exception_prefetch(IndexError, count, prefetch=2)
+        assert next(gen) == 1
+        gen.close()
+        time.sleep(0.3)
+        num_calls = len(calls)
+        time.sleep(0.3)
+        assert len(calls) == num_calls
+
+        for kwargs in ({'prefetch': 0}, {'batch': 0}):
+            with self.assertRaises(ValueError):
+                next(yield_until_exception_prefetch(IndexError, count, **kwargs))
+
+    def test_async_yield_until_exception(self):
+        import asyncio
+
+        def reader(values, error=IndexError):
+            values = list(values)
+
+            async def read():
+                await asyncio.sleep(0)
+                if not values:
+                    raise error
+                return values.pop(0)
+            return read
+
+        async def collect(*args, **kwargs):
+            result = []
+            try:
+                async for value in async_yield_until_exception(*args, **kwargs):
+                    result.append(value)
+            except KeyError:
+                result.append('KeyError')
+            return result
+
+        for prefetch in (0, 2):
+            assert asyncio.run(collect(IndexError, reader(range(5)), prefetch)) == [0, 1, 2, 3, 4]
+            assert asyncio.run(collect(IndexError, reader(range(5)), prefetch, batch=2)) == [[0, 1], [2, 3], [4]]
+            assert asyncio.run(collect(IndexError, reader(range(3), KeyError), prefetch, batch=2)) == [
+                [0, 1], [2], 'KeyError']
+        for kwargs in ({'prefetch': -1}, {'batch': 0}):
+            with self.assertRaises(ValueError):
+                asyncio.run(collect(IndexError, reader(range(3)), **kwargs))
+
+    def test_remove_duplicates_by_key(self):
+        items = [1, 2, 1, 3, 2, 4, 1]
+        assert list(remove_duplicates_by_key(items, lambda v: v)) == [1, 2, 3, 4]
+
+        seen = LRUSeen(2)
+        assert list(remove_duplicates_by_key(items, lambda v: v, seen)) == [1, 2, 3, 2, 4, 1]
+        assert (seen.lookups, seen.hits) == (7, 1)
+        assert seen.memory_usage() > 0
+
+        seen = BloomSeen(100, 0.01)
+        assert list(remove_duplicates_by_key(items, lambda v: v, seen)) == [1, 2, 3, 4]
+        assert seen.hit_rate == 3 / 7
+        assert seen.memory_usage() > seen.num_bits // 8
+
+        seen = BloomSeen(1000, 0.01)
+        assert sum(seen.add(i) for i in range(1000)) > 970
+        # Keys with equal hash() values don't collide.
+        seen = BloomSeen(1000, 0.01)
+        assert seen.add(-1) and seen.add(-2)
+        assert sum(seen.add(i * (2 ** 61 - 1)) for i in range(1, 1000)) > 970
+        assert not seen.add(-1)
+        assert seen.add(('a', 1)) and not seen.add(('a', 1))
+
+        with SpillingSeen(2) as seen:
+            assert list(remove_duplicates_by_key(items, lambda v: v, seen)) == [1, 2, 3, 4]
+            assert seen.spilled == 4
+            assert seen.hits == 3
+            assert seen.disk_usage() > 0
+
+    def test_show_exit(self):
+        assert show_exit(os.system("exit 1")) == "exit: 1"
+        assert show_exit(os.system("exit 2")) == "exit: 2"
+        assert show_exit(os.system("kill -9 $$")) == "signal: SIGKILL"
@@ -1,19 +1,94 @@
 """Snipppets of potentially reusable code that don't deserve their
-own library."""
+own library.
 
+To keep importing this module cheap, the standard library modules that
+are expensive to import and only needed by some of the functions are
+_LazyModule objects, imported on first use, and tables such as SIG_NAMES
+are built on first use.
+
+"""
+
+import array
 import bisect
+import collections
+import collections.abc
 import contextlib
-import inspect
+import functools
+import heapq
+import importlib
+import itertools
+import math
+import mmap
+import operator
 import os
-import shutil
-import signal
+import re
+import struct
 import sys
-import tempfile
-import unittest
+import time
+import zlib
 from functools import wraps
 
 
+class _LazyModule:
+    """Stands in for the module `name`, importing it when one of its
+    attributes is first used.
+
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        """Return the module itself, importing it if needed."""
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return "<lazy module {!r}>".format(self._name)
+
+
+asyncio = _LazyModule('asyncio')
+cProfile = _LazyModule('cProfile')
+futures = _LazyModule('concurrent.futures')
+hashlib = _LazyModule('hashlib')
+json = _LazyModule('json')
+pickle = _LazyModule('pickle')
+pstats = _LazyModule('pstats')
+queue = _LazyModule('queue')
+selectors = _LazyModule('selectors')
+shutil = _LazyModule('shutil')
+signal = _LazyModule('signal')
+sqlite3 = _LazyModule('sqlite3')
+string = _LazyModule('string')
+subprocess = _LazyModule('subprocess')
+tempfile = _LazyModule('tempfile')
+threading = _LazyModule('threading')
+tracemalloc = _LazyModule('tracemalloc')
+
+
+def _numpy():
+    """Return the numpy module, or None if it is not installed."""
+    global _numpy_module
+    if _numpy_module is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_module = numpy
+    return _numpy_module
+
+
+_numpy_module = False
+
+
 class Location:
+    __slots__ = ('name', 'line', 'col')
+
     def __init__(self, name, line, col):
         self.name = name
         self.line = line
@@ -23,17 +98,201 @@ class Location:
         return "{}:{}.{}".format(self.name, self.line, self.col)
 
 
+_ASCII_CHUNK_SIZE = 1 << 20
+_STR_NON_ASCII_RE = re.compile('[^\x00-\x7f]+')
+_STR_RUN_RE = re.compile('[\x80-\u07ff]+|[\u0800-\uffff]+|[\U00010000-\U0010ffff]+')
+_UTF8_NON_ASCII_RE = re.compile(b'[\x80-\xff]+')
+_UTF8_RUN_RE = re.compile(b'(?:[\xc0-\xdf][\x80-\xbf])+|(?:[\xe0-\xef][\x80-\xbf]{2})+'
+                          b'|(?:[\xf0-\xf7][\x80-\xbf]{3})+')
+
+
+def _non_ascii_runs(data):
+    """Generate (offset, length, width) for each run of non-ASCII code
+    points with the same UTF-8 width in `data`, which is a str or UTF-8
+    encoded bytes (or mmap). `offset` is an index into `data` and
+    `length` a number of code points. Invalid UTF-8 bytes are skipped,
+    and so are treated as single code points.
+
+    Chunks of ASCII are skipped with isascii(), which is much faster
+    than searching them with a regex.
+
+    """
+    is_str = isinstance(data, str)
+    non_ascii_re, run_re = (_STR_NON_ASCII_RE, _STR_RUN_RE) if is_str else (_UTF8_NON_ASCII_RE, _UTF8_RUN_RE)
+    size = len(data)
+    pos = 0
+    while pos < size:
+        chunk_end = pos + _ASCII_CHUNK_SIZE
+        if data[pos:chunk_end].isascii():
+            pos = chunk_end
+            continue
+        end = chunk_end
+        for span in non_ascii_re.finditer(data, pos, chunk_end):
+            start, end = span.span()
+            if end == chunk_end:
+                # The span may continue past the end of the chunk.
+                end = non_ascii_re.match(data, start).end()
+            for m in run_re.finditer(data, start, end):
+                run_start, run_end = m.span()
+                if is_str:
+                    lead = ord(data[run_start])
+                    width = 2 if lead < 0x800 else 3 if lead < 0x10000 else 4
+                    yield run_start, run_end - run_start, width
+                else:
+                    lead = data[run_start]
+                    width = 2 if lead < 0xe0 else 3 if lead < 0xf0 else 4
+                    yield run_start, (run_end - run_start) // width, width
+        pos = max(end, chunk_end)
+
+
+class _CodeUnitTable:
+    """Maps between code point offsets and UTF-8 byte or UTF-16 code unit
+    offsets of a str or UTF-8 encoded text.
+
+    The text is described by its runs of non-ASCII code points that all
+    have the same UTF-8 width, along with the byte and UTF-16 offsets at
+    which each run starts. ASCII-only text has no runs and so costs
+    nothing.
+
+    """
+
+    __slots__ = ('starts', 'lengths', 'widths', 'byte_starts', 'utf16_starts')
+
+    def __init__(self, data):
+        self.starts = starts = array.array('q')
+        self.lengths = lengths = array.array('q')
+        self.widths = widths = array.array('b')
+        self.byte_starts = byte_starts = array.array('q')
+        self.utf16_starts = utf16_starts = array.array('q')
+        byte_units = not isinstance(data, str)
+        extra_bytes = extra_utf16 = 0
+        for start, length, width in _non_ascii_runs(data):
+            if byte_units:
+                start -= extra_bytes
+            starts.append(start)
+            lengths.append(length)
+            widths.append(width)
+            byte_starts.append(start + extra_bytes)
+            utf16_starts.append(start + extra_utf16)
+            extra_bytes += length * (width - 1)
+            if width == 4:
+                extra_utf16 += length
+
+    def _extra(self, offset, unit_starts, utf16):
+        idx = bisect.bisect_right(self.starts, offset) - 1
+        if idx < 0:
+            return 0
+        width = self.widths[idx]
+        count = min(offset - self.starts[idx], self.lengths[idx])
+        if utf16:
+            return unit_starts[idx] - self.starts[idx] + (count if width == 4 else 0)
+        return unit_starts[idx] - self.starts[idx] + count * (width - 1)
+
+    def to_bytes(self, offset):
+        """Convert a code point offset to a UTF-8 byte offset."""
+        return offset + self._extra(offset, self.byte_starts, False)
+
+    def to_utf16(self, offset):
+        """Convert a code point offset to a UTF-16 code unit offset."""
+        return offset + self._extra(offset, self.utf16_starts, True)
+
+    def _from_units(self, offset, unit_starts, utf16):
+        idx = bisect.bisect_right(unit_starts, offset) - 1
+        if idx < 0:
+            return offset
+        width = self.widths[idx]
+        if utf16:
+            width = 2 if width == 4 else 1
+        into_run = offset - unit_starts[idx]
+        if into_run < self.lengths[idx] * width:
+            if into_run % width:
+                raise ValueError("Offset {} is within a character".format(offset))
+            return self.starts[idx] + into_run // width
+        return offset - (unit_starts[idx] - self.starts[idx]) - self.lengths[idx] * (width - 1)
+
+    def from_bytes(self, offset):
+        """Convert a UTF-8 byte offset to a code point offset."""
+        return self._from_units(offset, self.byte_starts, False)
+
+    def from_utf16(self, offset):
+        """Convert a UTF-16 code unit offset to a code point offset."""
+        return self._from_units(offset, self.utf16_starts, True)
+
+
 class Locator:
     """Locator provides a way to convert an absolute offset in a
     string into a Location object.
 
+    Line start offsets are kept in a compact array('q') rather than a
+    list of ints, so the index costs 8 bytes per line. To index a large
+    file without reading it into memory use Locator.from_file(), in
+    which case offsets are byte offsets into the file.
+
+    If `code_units` is true, offsets can also be converted between code
+    points, UTF-8 bytes and UTF-16 code units (as used by LSP clients)
+    with byte_offset(), code_point_offset(), utf16_location() and
+    offset_from_utf16(). This needs `data` to be scanned for non-ASCII
+    characters, but `data` itself is never kept.
+
     """
 
-    def __init__(self, data, name='<string>'):
+    _CHUNK_SIZE = 1 << 20
+
+    def __init__(self, data, name='<string>', code_units=False):
         self.name = name
-        self.line_offsets = [0]
-        for line_len in map(len, data.splitlines(True)):
-            self.line_offsets.append(self.line_offsets[-1] + line_len)
+        self.line_offsets = self._line_offsets(data, len(data))
+        self.offsets_are_bytes = not isinstance(data, str)
+        self._code_units = _CodeUnitTable(data) if code_units else None
+
+    @classmethod
+    def _line_offsets(cls, data, size):
+        # Split a chunk at a time so that only a chunk's worth of line
+        # strings ever exists at once. The last line of each chunk may be
+        # incomplete (or a '\r' whose '\n' is in the next chunk), so it
+        # is rescanned as part of the following chunk.
+        offsets = array.array('q', [0])
+        pos = 0
+        chunk_size = cls._CHUNK_SIZE
+        while pos < size:
+            end = pos + chunk_size
+            lines = data[pos:end].splitlines(True)
+            if end < size:
+                if len(lines) < 2:
+                    chunk_size *= 2
+                    continue
+                lines.pop()
+            ends = itertools.accumulate(map(len, lines), initial=pos)
+            next(ends)
+            offsets.extend(ends)
+            pos = offsets[-1]
+            chunk_size = cls._CHUNK_SIZE
+        return offsets
+
+    @classmethod
+    def from_file(cls, f, name=None, code_units=False):
+        """Create a Locator for a file, given either a path or a binary
+        file object.
+
+        The file is memory mapped and scanned for newline bytes (with
+        the same line boundaries as bytes.splitlines()), so the file is
+        never held in memory as a string. Offsets passed to locate()
+        are byte offsets.
+
+        `code_units` is as for Locator().
+
+        """
+        if isinstance(f, (str, bytes, os.PathLike)):
+            if name is None:
+                name = os.fsdecode(f)
+            with open(f, 'rb') as fobj:
+                return cls.from_file(fobj, name, code_units)
+
+        if name is None:
+            name = getattr(f, 'name', '<file>')
+        if os.fstat(f.fileno()).st_size == 0:
+            return cls(b'', name, code_units)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return cls(mm, name, code_units)
 
     def locate(self, offset):
         """Return a Location() object for the given offset."""
@@ -41,6 +300,513 @@ class Locator:
         col = offset - self.line_offsets[line - 1]
         return Location(self.name, line, col)
 
+    def locate_many(self, offsets):
+        """Locate many offsets at once.
+
+        Returns a pair of parallel (lines, cols) arrays, where lines[i]
+        and cols[i] are the line and column of offsets[i]. `offsets` need
+        not be sorted.
+
+        When numpy is available this uses numpy.searchsorted() and returns
+        numpy arrays; otherwise the offsets are visited in sorted order,
+        merging them against the line index, and array('q') objects are
+        returned.
+
+        """
+        np = _numpy()
+        if np is not None:
+            line_offsets = np.frombuffer(self.line_offsets, dtype=np.int64)
+            offsets = np.asarray(offsets, dtype=np.int64)
+            lines = np.searchsorted(line_offsets, offsets, side='right')
+            cols = offsets - line_offsets[lines - 1]
+            return lines, cols
+
+        offsets = array.array('q', offsets)
+        line_offsets = self.line_offsets
+        lines = array.array('q', bytes(8 * len(offsets)))
+        cols = array.array('q', lines)
+        line = 0
+        for idx in sorted(range(len(offsets)), key=offsets.__getitem__):
+            offset = offsets[idx]
+            # Offsets are visited in ascending order, so the search only
+            # ever needs to continue from the previous result.
+            line = bisect.bisect_right(line_offsets, offset, line)
+            lines[idx] = line
+            cols[idx] = offset - line_offsets[line - 1]
+        return lines, cols
+
+    def _code_unit_table(self):
+        if self._code_units is None:
+            raise ValueError("Code unit conversions need a Locator created with code_units=True")
+        return self._code_units
+
+    def byte_offset(self, offset):
+        """Convert a code point offset to a UTF-8 byte offset."""
+        return self._code_unit_table().to_bytes(offset)
+
+    def code_point_offset(self, offset):
+        """Convert a UTF-8 byte offset to a code point offset.
+
+        Raises ValueError if `offset` is not on a character boundary.
+
+        """
+        return self._code_unit_table().from_bytes(offset)
+
+    def _to_code_points(self, offset):
+        return self.code_point_offset(offset) if self.offsets_are_bytes else offset
+
+    def utf16_location(self, offset):
+        """Return a Location() object for the given offset, where the
+        column is counted in UTF-16 code units.
+
+        """
+        location = self.locate(offset)
+        line_start = self._to_code_points(self.line_offsets[location.line - 1])
+        code_units = self._code_unit_table()
+        location.col = code_units.to_utf16(self._to_code_points(offset)) - code_units.to_utf16(line_start)
+        return location
+
+    def offset_from_utf16(self, line, col):
+        """Return the offset of the given line and UTF-16 column.
+
+        Raises ValueError if `col` is within a surrogate pair.
+
+        """
+        code_units = self._code_unit_table()
+        line_start = self._to_code_points(self.line_offsets[line - 1])
+        offset = code_units.from_utf16(code_units.to_utf16(line_start) + col)
+        return self.byte_offset(offset) if self.offsets_are_bytes else offset
+
+
+class _FenwickTree:
+    """A binary indexed tree over a list of ints, supporting point updates,
+    prefix sums and prefix-sum search in O(log n).
+
+    """
+
+    __slots__ = ('_tree',)
+
+    def __init__(self, values):
+        tree = [0]
+        tree.extend(values)
+        size = len(tree)
+        for idx in range(1, size):
+            parent = idx + (idx & -idx)
+            if parent < size:
+                tree[parent] += tree[idx]
+        self._tree = tree
+
+    def add(self, idx, delta):
+        """Add `delta` to the value at index `idx`."""
+        tree = self._tree
+        idx += 1
+        while idx < len(tree):
+            tree[idx] += delta
+            idx += idx & -idx
+
+    def prefix_sum(self, count):
+        """Return the sum of the first `count` values."""
+        tree = self._tree
+        total = 0
+        while count > 0:
+            total += tree[count]
+            count -= count & -count
+        return total
+
+    def search(self, value):
+        """Return (count, total) where `count` is the largest number of
+        leading values whose sum (`total`) does not exceed `value`.
+
+        Values must be non-negative.
+
+        """
+        tree = self._tree
+        count = 0
+        total = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            idx = count + step
+            if idx < len(tree) and total + tree[idx] <= value:
+                count = idx
+                total += tree[idx]
+            step >>= 1
+        return count, total
+
+
+def _line_runs(text, shift=0):
+    """Return the runs of _non_ascii_runs() in a line of text as a flat
+    list of (offset, length, width) triples, with `shift` added to the
+    offsets.
+
+    """
+    runs = []
+    for start, length, width in _non_ascii_runs(text):
+        runs.extend((start + shift, length, width))
+    return runs
+
+
+def _clip_runs(runs, start, end, shift, byte_units):
+    """Return the parts of a line's runs within offsets [start, end) of
+    the line, with `shift` added to their offsets, as a list.
+
+    """
+    clipped = []
+    for idx in range(0, len(runs or ()), 3):
+        run_start, length, width = runs[idx:idx + 3]
+        unit = width if byte_units else 1
+        part_start = max(run_start, start)
+        part_end = min(run_start + length * unit, end)
+        if part_start < part_end:
+            clipped.extend((part_start + shift, (part_end - part_start) // unit, width))
+    return clipped
+
+
+def _runs_extra_bytes(runs):
+    """Return how many more UTF-8 bytes than code points a line's runs
+    have.
+
+    """
+    if not runs:
+        return 0
+    return sum(runs[idx + 1] * (runs[idx + 2] - 1) for idx in range(0, len(runs), 3))
+
+
+def _line_col_units(runs, col, byte_units):
+    """Return (code points, UTF-8 bytes, UTF-16 code units) before column
+    `col` of a line, where `col` is in bytes if `byte_units`, otherwise
+    in code points.
+
+    """
+    extra_bytes = extra_utf16 = 0
+    for idx in range(0, len(runs or ()), 3):
+        start, length, width = runs[idx:idx + 3]
+        if col <= start:
+            break
+        count = col - start
+        if byte_units:
+            if count < length * width and count % width:
+                raise ValueError("Column {} is within a character".format(col))
+            count //= width
+        count = min(count, length)
+        extra_bytes += count * (width - 1)
+        if width == 4:
+            extra_utf16 += count
+    code_points = col - extra_bytes if byte_units else col
+    return code_points, code_points + extra_bytes, code_points + extra_utf16
+
+
+def _line_col_from(runs, value, unit, byte_units):
+    """Return the column of a line, in bytes if `byte_units`, otherwise in
+    code points, that is `value` code points (`unit` 0), UTF-8 bytes (1)
+    or UTF-16 code units (2) into it.
+
+    """
+    extra_bytes = extra_utf16 = 0
+    for idx in range(0, len(runs or ()), 3):
+        start, length, width = runs[idx:idx + 3]
+        start_code_points = start - extra_bytes if byte_units else start
+        unit_width = (1, width, 2 if width == 4 else 1)[unit]
+        run_start = start_code_points + (0, extra_bytes, extra_utf16)[unit]
+        if value < run_start:
+            break
+        into_run = value - run_start
+        if into_run < length * unit_width:
+            if into_run % unit_width:
+                raise ValueError("Offset {} is within a character".format(value))
+            return start + into_run // unit_width * (width if byte_units else 1)
+        extra_bytes += length * (width - 1)
+        if width == 4:
+            extra_utf16 += length
+    code_points = value - (0, extra_bytes, extra_utf16)[unit]
+    return code_points + extra_bytes if byte_units else code_points
+
+
+class EditableLocator(Locator):
+    """A Locator that can be updated in place as the text it indexes is
+    edited, see apply_edit().
+
+    Line lengths are kept in blocks of a few hundred lines, with Fenwick
+    trees over the per-block character and line counts. Both locate()
+    and apply_edit() cost O(log n) plus the size of one block, rather
+    than the O(n) of building a new Locator. Occasionally an edit changes
+    the number of blocks, in which case the Fenwick trees are rebuilt
+    in O(number of blocks).
+
+    The last line is always stored, even when it is empty, as the
+    unterminated line that text inserted at the very end is added to.
+
+    Conversions between code points, bytes and UTF-16 stay available
+    through edits, at the same cost as locate(): each line with non-ASCII
+    characters stores its runs of them, and a third Fenwick tree holds
+    the size of each block in the other unit (bytes for str text, code
+    points for bytes). Finding the runs is quick for ASCII text, but
+    costs a few microseconds per run otherwise. As the runs are always
+    kept, `code_units` is accepted for compatibility with Locator but
+    ignored.
+
+    """
+
+    _BLOCK_SIZE = 256
+
+    def __init__(self, data, name='<string>', code_units=True):
+        self.name = name
+        offsets = self._line_offsets(data, len(data))
+        lengths = array.array('q', (end - start for start, end in zip(offsets, offsets[1:])))
+        # A line-break at the very end of the data starts an empty last line.
+        if not data or len((data[-1:] * 2).splitlines()) == 2:
+            lengths.append(0)
+        self.offsets_are_bytes = not isinstance(data, str)
+
+        runs = [None] * len(lengths)
+        line_runs = {}
+        for start, length, width in _non_ascii_runs(data):
+            unit = width if self.offsets_are_bytes else 1
+            end = start + length * unit
+            line = bisect.bisect_right(offsets, start) - 1
+            # A run of str characters may include line separators such as
+            # '\x85', so split it at line boundaries.
+            while start < end:
+                part_end = min(end, offsets[line + 1]) if line + 1 < len(offsets) else end
+                line_runs.setdefault(line, []).extend((start - offsets[line], (part_end - start) // unit, width))
+                start = part_end
+                line += 1
+        for line, line_run in line_runs.items():
+            runs[line] = tuple(line_run)
+
+        blocks = self._chunk(lengths)
+        block_runs = self._chunk(runs)
+        self._block_totals = [sum(block) for block in blocks]
+        self._block_extras = [sum(map(_runs_extra_bytes, block)) for block in block_runs]
+        self._size = len(data)
+        self._num_lines = len(lengths)
+        self._set_blocks(blocks, block_runs)
+
+    def _chunk(self, lines):
+        size = self._BLOCK_SIZE
+        if len(lines) <= 2 * size:
+            return [lines]
+        return [lines[idx:idx + size] for idx in range(0, len(lines), size)]
+
+    def _set_blocks(self, blocks, block_runs):
+        self._blocks = blocks
+        self._runs = block_runs
+        self._block_sums = _FenwickTree(self._block_totals)
+        self._block_counts = _FenwickTree(map(len, blocks))
+        sign = -1 if self.offsets_are_bytes else 1
+        self._block_other_sums = _FenwickTree(total + sign * extra
+                                              for total, extra in zip(self._block_totals, self._block_extras))
+
+    @property
+    def line_offsets(self):
+        """The line start offsets, as Locator.line_offsets. This is
+        recomputed on each access.
+
+        """
+        offsets = array.array('q', [0])
+        offsets.extend(itertools.accumulate(itertools.chain.from_iterable(self._blocks)))
+        if self._blocks[-1][-1] == 0:
+            offsets.pop()
+        return offsets
+
+    def __len__(self):
+        """Return the length of the indexed text."""
+        return self._size
+
+    def _find(self, offset):
+        """Return (block index, index in block, line start) for the line
+        containing `offset`. Offsets at or past the end of the text are in
+        the last line.
+
+        """
+        blocks = self._blocks
+        block_idx, block_start = self._block_sums.search(offset)
+        if block_idx == len(blocks):
+            block_idx -= 1
+            idx = len(blocks[block_idx]) - 1
+            return block_idx, idx, self._size - blocks[block_idx][idx]
+        ends = list(itertools.accumulate(blocks[block_idx]))
+        idx = bisect.bisect_right(ends, offset - block_start)
+        return block_idx, idx, block_start + (ends[idx - 1] if idx else 0)
+
+    def _find_other(self, offset):
+        """As _find(), but for an offset in the other unit (bytes for str
+        text, code points for bytes), returning (block index, index in
+        block, line start, line start in the other unit).
+
+        """
+        blocks = self._blocks
+        block_idx, other_start = self._block_other_sums.search(offset)
+        if block_idx == len(blocks):
+            block_idx -= 1
+            other_start = self._block_other_sums.prefix_sum(block_idx)
+        start = self._block_sums.prefix_sum(block_idx)
+        block = blocks[block_idx]
+        runs = self._runs[block_idx]
+        sign = -1 if self.offsets_are_bytes else 1
+        for idx in range(len(block)):
+            other_length = block[idx] + sign * _runs_extra_bytes(runs[idx])
+            if idx == len(block) - 1 or other_start + other_length > offset:
+                break
+            other_start += other_length
+            start += block[idx]
+        return block_idx, idx, start, other_start
+
+    def _find_line(self, line):
+        """Return (block index, index in block, line start) for a line
+        number.
+
+        """
+        block_idx, lines_before = self._block_counts.search(line - 1)
+        if line < 1 or block_idx == len(self._blocks):
+            raise IndexError("Line {} out of range".format(line))
+        idx = line - 1 - lines_before
+        return block_idx, idx, self._block_sums.prefix_sum(block_idx) + sum(self._blocks[block_idx][:idx])
+
+    def _other_start(self, block_idx, idx):
+        """Return the start of a line in the other unit."""
+        sign = -1 if self.offsets_are_bytes else 1
+        runs = self._runs[block_idx]
+        return (self._block_other_sums.prefix_sum(block_idx) + sum(self._blocks[block_idx][:idx])
+                + sign * sum(_runs_extra_bytes(runs[line]) for line in range(idx) if runs[line]))
+
+    def locate(self, offset):
+        """Return a Location() object for the given offset."""
+        if offset >= self._size and self._blocks[-1][-1] != 0:
+            return Location(self.name, self._num_lines + 1, offset - self._size)
+        block_idx, idx, line_start = self._find(offset)
+        line = self._block_counts.prefix_sum(block_idx) + idx + 1
+        return Location(self.name, line, offset - line_start)
+
+    def locate_many(self, offsets):
+        """Locate many offsets at once, as Locator.locate_many()."""
+        lines = array.array('q')
+        cols = array.array('q')
+        for offset in offsets:
+            location = self.locate(offset)
+            lines.append(location.line)
+            cols.append(location.col)
+        return lines, cols
+
+    def byte_offset(self, offset):
+        """Convert a code point offset to a UTF-8 byte offset."""
+        if self.offsets_are_bytes:
+            block_idx, idx, line_start, other_start = self._find_other(offset)
+            return line_start + _line_col_from(self._runs[block_idx][idx], offset - other_start, 0, True)
+        block_idx, idx, line_start = self._find(offset)
+        return (self._other_start(block_idx, idx)
+                + _line_col_units(self._runs[block_idx][idx], offset - line_start, False)[1])
+
+    def code_point_offset(self, offset):
+        """Convert a UTF-8 byte offset to a code point offset.
+
+        Raises ValueError if `offset` is not on a character boundary.
+
+        """
+        if self.offsets_are_bytes:
+            block_idx, idx, line_start = self._find(offset)
+            return (self._other_start(block_idx, idx)
+                    + _line_col_units(self._runs[block_idx][idx], offset - line_start, True)[0])
+        block_idx, idx, line_start, other_start = self._find_other(offset)
+        return line_start + _line_col_from(self._runs[block_idx][idx], offset - other_start, 1, False)
+
+    def utf16_location(self, offset):
+        """Return a Location() object for the given offset, where the
+        column is counted in UTF-16 code units.
+
+        """
+        location = self.locate(offset)
+        if location.line <= self._num_lines:
+            block_idx, idx, line_start = self._find(offset)
+            location.col = _line_col_units(self._runs[block_idx][idx], offset - line_start, self.offsets_are_bytes)[2]
+        return location
+
+    def offset_from_utf16(self, line, col):
+        """Return the offset of the given line and UTF-16 column.
+
+        Raises ValueError if `col` is within a surrogate pair.
+
+        """
+        if line == self._num_lines + 1:
+            # The line after the end of the text, as returned by locate().
+            return self._size + col
+        block_idx, idx, line_start = self._find_line(line)
+        return line_start + _line_col_from(self._runs[block_idx][idx], col, 2, self.offsets_are_bytes)
+
+    def apply_edit(self, start, end, new_text):
+        """Update the index for the text in [start, end) being replaced with
+        `new_text`.
+
+        Note: line-breaks are only looked for within `new_text`, so an
+        edit that splits a '\\r\\n' pair, or that joins a '\\r' and a
+        '\\n' into one, leaves the line count wrong.
+
+        """
+        if not 0 <= start <= end <= self._size:
+            raise ValueError("Invalid edit range [{}, {}) for text of length {}".format(start, end, self._size))
+
+        blocks = self._blocks
+        first_block, first_idx, first_start = self._find(start)
+        last_block, last_idx, last_start = self._find(end)
+        last_length = blocks[last_block][last_idx]
+        head = start - first_start
+        tail = last_start + last_length - end
+
+        pieces = new_text.splitlines(True)
+        remainder = new_text[:0]
+        if pieces and len(pieces[-1].splitlines()[0]) == len(pieces[-1]):
+            remainder = pieces.pop()
+        new_lines = array.array('q', map(len, pieces))
+        new_lines.append(len(remainder) + tail)
+        new_lines[0] += head
+
+        # The runs of the edited lines: those of the text before `start`
+        # on the first line, of `new_text`, and of the text after `end` on
+        # the last line.
+        new_runs = []
+        line_runs = _clip_runs(self._runs[first_block][first_idx], 0, head, 0, self.offsets_are_bytes)
+        col = head
+        for piece in pieces:
+            line_runs.extend(_line_runs(piece, col))
+            new_runs.append(tuple(line_runs) or None)
+            line_runs = []
+            col = 0
+        line_runs.extend(_line_runs(remainder, col))
+        col += len(remainder)
+        line_runs.extend(_clip_runs(self._runs[last_block][last_idx], last_length - tail, last_length,
+                                    col - (last_length - tail), self.offsets_are_bytes))
+        new_runs.append(tuple(line_runs) or None)
+
+        lines = blocks[first_block][:first_idx]
+        lines.extend(new_lines)
+        lines.extend(blocks[last_block][last_idx + 1:])
+        runs = self._runs[first_block][:first_idx]
+        runs.extend(new_runs)
+        runs.extend(self._runs[last_block][last_idx + 1:])
+
+        size_delta = len(new_text) - (end - start)
+        num_lines_delta = len(lines) - sum(map(len, blocks[first_block:last_block + 1]))
+        self._size += size_delta
+        self._num_lines += num_lines_delta
+        if first_block == last_block and len(lines) <= 2 * self._BLOCK_SIZE:
+            extra = sum(map(_runs_extra_bytes, runs))
+            extra_delta = extra - self._block_extras[first_block]
+            blocks[first_block] = lines
+            self._runs[first_block] = runs
+            self._block_totals[first_block] += size_delta
+            self._block_extras[first_block] = extra
+            self._block_sums.add(first_block, size_delta)
+            self._block_counts.add(first_block, num_lines_delta)
+            self._block_other_sums.add(first_block, size_delta + (-extra_delta if self.offsets_are_bytes else extra_delta))
+        else:
+            new_blocks = self._chunk(lines)
+            new_block_runs = self._chunk(runs)
+            blocks[first_block:last_block + 1] = new_blocks
+            self._runs[first_block:last_block + 1] = new_block_runs
+            self._block_totals[first_block:last_block + 1] = [sum(block) for block in new_blocks]
+            self._block_extras[first_block:last_block + 1] = [sum(map(_runs_extra_bytes, block))
+                                                              for block in new_block_runs]
+            self._set_blocks(blocks, self._runs)
+
 
 def import_from_dir(module_name, dir_name):
     """Import a module form a specific directory.
@@ -107,6 +873,66 @@ def dict_inverse(dct, exact=False):
     return r
 
 
+def grouped_indices(keys):
+    """Group the positions of `keys` (a numpy array, buffer or sequence)
+    by value. This is an array based form of dict_grouped_by_key() for
+    large numbers of numeric keys.
+
+    Returns a tuple (unique_keys, offsets, indices), where unique_keys
+    are the distinct keys in ascending order, and the positions of the
+    items equal to unique_keys[i] are indices[offsets[i]:offsets[i + 1]],
+    in ascending order.
+
+    With numpy this is computed with a stable argsort and numpy arrays
+    are returned. Otherwise it is computed in Python, returning a list of
+    keys and array('q') offsets and indices.
+
+    Example (without numpy):
+
+    > grouped_indices([3, 1, 3, 2])
+    ([1, 2, 3], array('q', [0, 1, 2, 4]), array('q', [1, 3, 0, 2]))
+
+    """
+    np = _numpy()
+    if np is not None:
+        keys = np.asarray(keys)
+        indices = np.argsort(keys, kind='stable')
+        unique_keys, starts = np.unique(keys[indices], return_index=True)
+        return unique_keys, np.append(starts, len(keys)), indices
+
+    indices = array.array('q', sorted(range(len(keys)), key=keys.__getitem__))
+    unique_keys = []
+    offsets = array.array('q')
+    for offset, idx in enumerate(indices):
+        key = keys[idx]
+        if not unique_keys or key != unique_keys[-1]:
+            unique_keys.append(key)
+            offsets.append(offset)
+    offsets.append(len(indices))
+    return unique_keys, offsets, indices
+
+
+def dict_inverse_arrays(keys, values):
+    """An array based form of dict_inverse() for the mapping of keys[i]
+    to values[i], for large numbers of numeric keys and values.
+
+    Returns a tuple (unique_values, offsets, inverse_keys), where the
+    keys that map to unique_values[i] are
+    inverse_keys[offsets[i]:offsets[i + 1]]. See grouped_indices().
+
+    Example (without numpy):
+
+    > dict_inverse_arrays([1, 2, 3], ['a', 'a', 'c'])
+    (['a', 'c'], array('q', [0, 2, 3]), [1, 2, 3])
+
+    """
+    unique_values, offsets, indices = grouped_indices(values)
+    np = _numpy()
+    if np is not None:
+        return unique_values, offsets, np.asarray(keys)[indices]
+    return unique_values, offsets, [keys[idx] for idx in indices]
+
+
 class _GeneratorSimpleContextManager(contextlib._GeneratorContextManager):
     """Helper for @simplecontextmanager decorator."""
 
@@ -165,7 +991,7 @@ def simplecontextmanager(func):
     """
     @wraps(func)
     def helper(*args, **kwds):
-        return _GeneratorSimpleContextManager(func, *args, **kwds)
+        return _GeneratorSimpleContextManager(func, args, kwds)
     return helper
 
 
@@ -189,6 +1015,103 @@ def chdir(path):
     os.chdir(cwd)
 
 
+class DirHandle:
+    """A handle on an open directory, for working with paths relative to
+    it without changing the process-wide current working directory.
+
+    Relative paths passed to the methods are resolved against the
+    directory using the *at() system calls (via the `dir_fd` arguments of
+    the os functions), so each thread or task can have its own handle
+    without any locking. Absolute paths are used as-is.
+
+    The directory is closed when the context exits, or by close().
+
+    Example:
+
+    with DirHandle("build") as build:
+        with build.open("log.txt", "w") as f:
+            f.write("done\\n")
+        print(build.listdir())
+
+    """
+
+    _FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_CLOEXEC', 0)
+
+    def __init__(self, path, dir_fd=None):
+        self.path = path
+        self.fd = os.open(path, self._FLAGS, dir_fd=dir_fd)
+
+    def __repr__(self):
+        return "DirHandle({!r}, fd={})".format(self.path, self.fd)
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def subdir(self, path):
+        """Return a new DirHandle for `path` relative to this directory."""
+        return DirHandle(path, dir_fd=self.fd)
+
+    def _opener(self, path, flags):
+        return os.open(path, flags, 0o666, dir_fd=self.fd)
+
+    def open(self, path, mode='r', *args, **kwargs):
+        """open() `path` relative to this directory."""
+        return open(path, mode, *args, opener=self._opener, **kwargs)
+
+    def stat(self, path, follow_symlinks=True):
+        return os.stat(path, dir_fd=self.fd, follow_symlinks=follow_symlinks)
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def listdir(self, path='.'):
+        # os.listdir(fd) rewinds a duplicate of the fd, sharing its offset,
+        # so list through a separate fd to be safe across threads.
+        with self.subdir(path) as d:
+            return os.listdir(d.fd)
+
+    def scandir(self, path='.'):
+        """Return a list of the os.DirEntry objects for the directory.
+        Their `path` attributes are just their names.
+
+        """
+        with self.subdir(path) as d, os.scandir(d.fd) as it:
+            return list(it)
+
+    def mkdir(self, path, mode=0o777):
+        os.mkdir(path, mode, dir_fd=self.fd)
+
+    def rmdir(self, path):
+        os.rmdir(path, dir_fd=self.fd)
+
+    def unlink(self, path):
+        os.unlink(path, dir_fd=self.fd)
+
+    def rename(self, src, dst):
+        os.rename(src, dst, src_dir_fd=self.fd, dst_dir_fd=self.fd)
+
+    def symlink(self, src, dst):
+        os.symlink(src, dst, dir_fd=self.fd)
+
+    def readlink(self, path):
+        return os.readlink(path, dir_fd=self.fd)
+
+
 @simplecontextmanager
 def umask(new_mask):
     """unmask context manager.
@@ -208,6 +1131,9 @@ def update_env(env):
 
     Updates os.environ with the specified `env` for the duration of the context.
 
+    As this modifies the whole process's environment it isn't safe to use
+    from multiple threads, see EnvOverlay for an alternative.
+
     """
     old_env = {}
     for key in env:
@@ -223,32 +1149,647 @@ def update_env(env):
             os.environ[key] = old_env[key]
 
 
+class EnvOverlay(collections.abc.Mapping):
+    """An immutable environment made up of a snapshot of os.environ with
+    stacked layers of changes, for passing to subprocesses.
+
+    Unlike update_env() this never modifies os.environ, so overlays can
+    be used from many threads at once without locking. Each overlay's
+    complete environment is computed once, on first use, and then shared
+    by every subprocess it spawns.
+
+    In `env` a value of None removes the variable.
+
+    Example:
+
+    build_env = EnvOverlay({'CC': 'clang'})
+    debug_env = build_env.overlay({'CFLAGS': '-O0 -g'})
+    debug_env.run(['make'], check=True)
+
+    """
+
+    def __init__(self, env=None, parent=None):
+        self._parent = parent
+        self._changes = dict(env or {})
+        self._environ = None
+        self._base = dict(os.environ) if parent is None else None
+
+    def overlay(self, env):
+        """Return a new EnvOverlay with `env` layered on top of this one."""
+        return EnvOverlay(env, self)
+
+    @property
+    def environ(self):
+        """The complete environment as a dict. This is shared, so must not
+        be modified.
+
+        """
+        if self._environ is None:
+            environ = dict(self._base if self._parent is None else self._parent.environ)
+            for key, value in self._changes.items():
+                if value is None:
+                    environ.pop(key, None)
+                else:
+                    environ[key] = value
+            self._environ = environ
+        return self._environ
+
+    def __getitem__(self, key):
+        return self.environ[key]
+
+    def __iter__(self):
+        return iter(self.environ)
+
+    def __len__(self):
+        return len(self.environ)
+
+    def popen(self, args, **kwargs):
+        """subprocess.Popen() with this environment."""
+        return subprocess.Popen(args, env=self.environ, **kwargs)
+
+    def run(self, args, **kwargs):
+        """subprocess.run() with this environment."""
+        return subprocess.run(args, env=self.environ, **kwargs)
+
+
 @simplecontextmanager
-def tempdir():
+def tempdir(pool=None):
+    """Temporary directory context manager.
+
+    Creates a temporary directory for the duration of the context. If a
+    TempdirPool is given as `pool` the directory comes from the pool.
+
+    """
+    if pool is not None:
+        with pool.tempdir() as tmpdir:
+            yield tmpdir
+        return
     tmpdir = tempfile.mkdtemp()
     yield tmpdir
     shutil.rmtree(tmpdir)
 
 
+def _remove_contents(path):
+    """Remove everything within the directory `path`, but not `path`
+    itself.
+
+    """
+    with os.scandir(path) as it:
+        entries = list(it)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            _remove_contents(entry.path)
+            os.rmdir(entry.path)
+        else:
+            os.unlink(entry.path)
+
+
+class TempdirPool:
+    """A pool of temporary directories that are reused, rather than being
+    created and removed each time.
+
+    On leaving a tempdir() context the directory is emptied on a
+    background thread (or `threads` of them) and then returned to the
+    pool, so the caller doesn't wait for the removal. At most `max_dirty`
+    directories may be waiting to be emptied; beyond that leaving a
+    context blocks until one has been.
+
+    Directories are created in `dir`, or if `tmpfs` is True and `dir`
+    isn't given, in /dev/shm when it exists.
+
+    The following statistics are kept:
+
+        created: directories created
+        reused: directories reused from the pool
+        setup_time: seconds spent entering tempdir() contexts
+        teardown_time: seconds spent leaving tempdir() contexts
+        cleanup_time: seconds spent emptying directories in the background
+
+    Use close(), or use the pool as a context manager, to wait for
+    outstanding cleanups and remove the pooled directories. A directory
+    still in use when the pool is closed is removed when its context is
+    left.
+
+    """
+
+    def __init__(self, dir=None, tmpfs=False, max_dirty=64, threads=1):
+        if max_dirty < 1:
+            raise ValueError("max_dirty must be at least 1")
+        if dir is None and tmpfs and os.path.isdir('/dev/shm'):
+            dir = '/dev/shm'
+        self.dir = dir
+        self.max_dirty = max_dirty
+        self.created = 0
+        self.reused = 0
+        self.setup_time = 0.0
+        self.teardown_time = 0.0
+        self.cleanup_time = 0.0
+        self._free = []
+        self._dirty = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._executor = futures.ThreadPoolExecutor(threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _acquire(self):
+        with self._cond:
+            if self._closed:
+                raise ValueError("TempdirPool is closed")
+            if self._free:
+                self.reused += 1
+                return self._free.pop()
+            self.created += 1
+        return tempfile.mkdtemp(dir=self.dir)
+
+    def _release(self, path):
+        with self._cond:
+            while self._dirty >= self.max_dirty and not self._closed:
+                self._cond.wait()
+            if not self._closed:
+                # Submitted with the lock held, so close() can't shut
+                # down the executor in between.
+                self._dirty += 1
+                self._executor.submit(self._clean, path)
+                return
+        shutil.rmtree(path)
+
+    def _clean(self, path):
+        start = time.perf_counter()
+        try:
+            os.chmod(path, 0o700)
+            _remove_contents(path)
+        except OSError:
+            shutil.rmtree(path, ignore_errors=True)
+            reusable = False
+        else:
+            reusable = True
+        with self._cond:
+            if reusable:
+                self._free.append(path)
+            self._dirty -= 1
+            self.cleanup_time += time.perf_counter() - start
+            self._cond.notify_all()
+
+    @simplecontextmanager
+    def tempdir(self):
+        """Temporary directory context manager, as util.tempdir()."""
+        start = time.perf_counter()
+        path = self._acquire()
+        with self._cond:
+            self.setup_time += time.perf_counter() - start
+        yield path
+        start = time.perf_counter()
+        self._release(path)
+        with self._cond:
+            self.teardown_time += time.perf_counter() - start
+
+    def close(self):
+        """Wait for outstanding cleanups and remove all directories in the
+        pool.
+
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._executor.shutdown(wait=True)
+        for path in self._free:
+            os.rmdir(path)
+        self._free = []
+
+
 def touch(path):
     """Create an empty file (just like the unix touch command)."""
     open(path, 'w').close()
 
 
-def file_list(root, full_path=False, sort=True):
+class PathMatcher:
+    """Matches relative paths against a list of gitignore-style patterns,
+    compiled once into a single regular expression.
+
+    As in .gitignore files:
+
+        - '*', '?' and '[...]' match within a single path component and
+          '**' matches any number of components;
+        - a pattern containing a '/' (other than a trailing one) is
+          relative to the root, otherwise it matches at any depth;
+        - a pattern ending in '/' only matches directories;
+        - blank lines and lines starting with '#' are ignored.
+
+    A path also matches if any of its parent directories match. Negated
+    ('!') patterns are not supported.
+
+    """
+
+    def __init__(self, patterns):
+        alternatives = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            if pattern.startswith('!'):
+                raise ValueError("Negated patterns are not supported: {}".format(pattern))
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            anchored = '/' in pattern
+            regex = self._translate(pattern.lstrip('/'))
+            if not anchored:
+                regex = '(?:.*/)?' + regex
+            alternatives.append(regex + ('/.*' if dir_only else '(?:/.*)?'))
+        self._regex = re.compile('|'.join(alternatives) or '(?!)', re.DOTALL)
+
+    @staticmethod
+    def _translate(pattern):
+        out = []
+        idx = 0
+        while idx < len(pattern):
+            c = pattern[idx]
+            idx += 1
+            if c == '*':
+                if pattern.startswith('*/', idx):
+                    out.append('(?:.*/)?')
+                    idx += 2
+                elif pattern.startswith('*', idx):
+                    out.append('.*')
+                    idx += 1
+                else:
+                    out.append('[^/]*')
+            elif c == '?':
+                out.append('[^/]')
+            elif c == '[' and pattern.find(']', idx + 1) != -1:
+                end = pattern.find(']', idx + 1)
+                chars = pattern[idx:end]
+                idx = end + 1
+                negate = chars[:1] in ('!', '^')
+                if negate:
+                    chars = chars[1:]
+                out.append('(?!/)[{}{}]'.format('^' if negate else '', chars.replace('\\', '\\\\')))
+            elif c == '\\' and idx < len(pattern):
+                out.append(re.escape(pattern[idx]))
+                idx += 1
+            else:
+                out.append(re.escape(c))
+        return ''.join(out)
+
+    def match(self, path, is_dir=False):
+        """Return True if the relative `path` matches any pattern."""
+        return self._regex.fullmatch(path + '/' if is_dir else path) is not None
+
+
+def _scan_dir(path, sort, stat):
+    """Return the (files, dirs) DirEntry lists of the directory `path`.
+
+    As with os.walk(), a symlink to a directory is listed in `dirs` but
+    should not be descended into, and an unreadable directory is
+    treated as empty.
+
+    """
+    files = []
+    dirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    dirs.append(entry)
+                else:
+                    if stat:
+                        try:
+                            entry.stat()
+                        except OSError:
+                            pass
+                    files.append(entry)
+    except OSError:
+        pass
+    if sort:
+        files.sort(key=lambda entry: entry.name)
+        dirs.sort(key=lambda entry: entry.name)
+    return files, dirs
+
+
+# The most directories _walk_files() reads ahead, per thread.
+_READ_AHEAD_PER_THREAD = 4
+
+
+def _walk_files(root, sort, threads, prune=None, stat=False):
+    """Generate (relative path, DirEntry) for each file below `root`, in
+    the same top-down order as os.walk().
+
+    Directories for which prune(relative path) is True are skipped.
+
+    If `threads` is given directories are read concurrently on a pool of
+    that many threads, and if `stat` is True each file has its stat()
+    result fetched (and cached by the DirEntry) on the pool as well. The
+    directories that will be generated next are read ahead of the
+    consumer, but no more than _READ_AHEAD_PER_THREAD * `threads` of them
+    at once, so memory use is bounded by the DirEntry lists of that many
+    directories (plus the stack of directories still to be read, as
+    without threads).
+
+    """
+    if not threads:
+        stack = [(root, '')]
+        while stack:
+            path, rel = stack.pop()
+            files, dirs = _scan_dir(path, sort, False)
+            for entry in files:
+                yield os.path.join(rel, entry.name), entry
+            for entry in reversed(dirs):
+                sub_rel = os.path.join(rel, entry.name)
+                if not entry.is_symlink() and not (prune and prune(sub_rel)):
+                    stack.append((entry.path, sub_rel))
+        return
+
+    executor = futures.ThreadPoolExecutor(threads)
+    max_reading = _READ_AHEAD_PER_THREAD * threads
+    try:
+        # Each item is [path, relative path, future of _scan_dir() or None],
+        # with the next directory to generate last.
+        stack = [[root, '', None]]
+        reading = 0
+        while stack:
+            # Start reading the directories nearest the top of the stack.
+            for item in reversed(stack):
+                if reading >= max_reading and item is not stack[-1]:
+                    break
+                if item[2] is None:
+                    item[2] = executor.submit(_scan_dir, item[0], sort, stat)
+                    reading += 1
+            path, rel, future = stack.pop()
+            reading -= 1
+            files, dirs = future.result()
+            for entry in files:
+                yield os.path.join(rel, entry.name), entry
+            for entry in reversed(dirs):
+                sub_rel = os.path.join(rel, entry.name)
+                if not entry.is_symlink() and not (prune and prune(sub_rel)):
+                    stack.append([entry.path, sub_rel, None])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def file_list(root, full_path=False, sort=True, threads=None, entries=False, include=None, exclude=None):
+    """Generate the paths of all files below `root`.
+
+    Paths are relative to `root` unless `full_path` is True. When `sort`
+    is True files are generated in a deterministic order: each
+    directory's files by name, followed by its sub-directories by name.
+
+    Passing `threads` reads directories concurrently on a thread pool,
+    which helps on high-latency file systems such as NFS. The order is
+    the same as without threads. Only a few directories per thread are
+    read ahead of the files generated, so memory use does not grow with
+    the size of the tree.
+
+    If `entries` is True (path, os.DirEntry) pairs are generated, so
+    that callers can use the entry's cached type and stat() information
+    rather than calling os.stat() again. With `threads` the entries'
+    stat() information is fetched on the thread pool too.
+
+    `include` and `exclude` filter the files by gitignore-style patterns
+    matched against their relative paths (see PathMatcher), and may be
+    given as a list of patterns or a PathMatcher. Only files that match
+    `include` (if given) and don't match `exclude` are generated.
+    Directories matching `exclude` are not read at all.
+
+    """
     if not root.endswith('/'):
         root += '/'
-    for base, dirs, files in os.walk(root):
-        if sort:
-            dirs.sort()
-            files.sort()
-        if not full_path:
-            base = base[len(root):]
-        for f in files:
-            yield os.path.join(base, f)
+    if include is not None and not isinstance(include, PathMatcher):
+        include = PathMatcher(include)
+    if exclude is not None and not isinstance(exclude, PathMatcher):
+        exclude = PathMatcher(exclude)
+    prune = None
+    if exclude is not None:
+        prune = functools.partial(exclude.match, is_dir=True)
+    for path, entry in _walk_files(root, sort, threads, prune, stat=entries):
+        if include is not None and not include.match(path):
+            continue
+        if exclude is not None and exclude.match(path):
+            continue
+        if full_path:
+            path = root + path
+        yield (path, entry) if entries else path
+
+
+FileChanges = collections.namedtuple('FileChanges', 'added modified removed snapshot')
+
+
+class FileSnapshot:
+    """A record of the files below a directory, as used by
+    file_list_changes().
+
+    `dirs` maps each directory's relative path to a tuple of
+    (mtime_ns, subdirectory names, file names), and `files` maps each
+    file's relative path to a tuple of (inode, size, mtime_ns).
+
+    Snapshots are saved in a compact binary format: per directory, its
+    path and mtime followed by the names (not full paths) and stat
+    fields of its entries, all zlib compressed.
 
+    """
 
-SIG_NAMES = dict((k, v) for v, k in signal.__dict__.items() if v.startswith('SIG'))
+    _MAGIC = b'pyutil-snapshot-1\n'
+    _DIR = struct.Struct('<qII')
+    _FILE = struct.Struct('<QQq')
+    _LEN = struct.Struct('<I')
+
+    def __init__(self):
+        self.dirs = {}
+        self.files = {}
+
+    def subtree_files(self, rel):
+        """Generate the paths of all files in the snapshot below the
+        directory `rel`.
+
+        """
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            _, subdirs, files = self.dirs[rel]
+            for name in files:
+                yield os.path.join(rel, name)
+            stack.extend(os.path.join(rel, name) for name in reversed(subdirs))
+
+    def save(self, path):
+        """Save the snapshot to `path`, atomically replacing any existing
+        file.
+
+        """
+        dir_struct = self._DIR
+        file_struct = self._FILE
+        len_struct = self._LEN
+        out = bytearray()
+
+        def add_name(name):
+            name = os.fsencode(name)
+            out.extend(len_struct.pack(len(name)))
+            out.extend(name)
+
+        for rel, (mtime_ns, subdirs, files) in self.dirs.items():
+            out.extend(dir_struct.pack(mtime_ns, len(subdirs), len(files)))
+            add_name(rel)
+            for name in subdirs:
+                add_name(name)
+            for name in files:
+                add_name(name)
+                out.extend(file_struct.pack(*self.files[os.path.join(rel, name)]))
+
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(self._MAGIC)
+            f.write(zlib.compress(out))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a snapshot previously saved to `path`."""
+        dir_struct = cls._DIR
+        file_struct = cls._FILE
+        len_struct = cls._LEN
+        with open(path, 'rb') as f:
+            magic = f.read(len(cls._MAGIC))
+            if magic != cls._MAGIC:
+                raise ValueError("{} is not a file snapshot".format(path))
+            data = zlib.decompress(f.read())
+
+        self = cls()
+        pos = 0
+
+        def read_name():
+            nonlocal pos
+            (length, ) = len_struct.unpack_from(data, pos)
+            pos += len_struct.size + length
+            return os.fsdecode(data[pos - length:pos])
+
+        while pos < len(data):
+            mtime_ns, num_subdirs, num_files = dir_struct.unpack_from(data, pos)
+            pos += dir_struct.size
+            rel = read_name()
+            subdirs = tuple(read_name() for _ in range(num_subdirs))
+            files = []
+            for _ in range(num_files):
+                name = read_name()
+                self.files[os.path.join(rel, name)] = file_struct.unpack_from(data, pos)
+                pos += file_struct.size
+                files.append(name)
+            self.dirs[rel] = (mtime_ns, subdirs, tuple(files))
+        return self
+
+
+def file_list_changes(root, snapshot=None, trust_dir_mtime=False):
+    """Compare the files below `root` against `snapshot` (a FileSnapshot,
+    or None for an empty snapshot).
+
+    Returns a FileChanges tuple of (added, modified, removed, snapshot),
+    where the first three are lists of file paths relative to `root`,
+    and `snapshot` is a new FileSnapshot of the current state to pass to
+    the next call. A file is modified if its inode, size or mtime has
+    changed. Files are found as for file_list().
+
+    A directory whose mtime is unchanged since the snapshot has not had
+    entries added, removed or renamed, so it is not read again; only its
+    files and subdirectories are stat()ed. If `trust_dir_mtime` is True
+    its files are not stat()ed either, so the cost of an unchanged tree
+    is one stat() per directory. In that mode only files that are
+    replaced (e.g. written to a temporary file and renamed into place)
+    are seen as modified, not those modified in place.
+
+    """
+    if not root.endswith('/'):
+        root += '/'
+    old = snapshot if snapshot is not None else FileSnapshot()
+    new = FileSnapshot()
+    added, modified, removed = [], [], []
+
+    def check_file(rel, st):
+        stat_key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        old_stat_key = old.files.get(rel)
+        if old_stat_key is None:
+            added.append(rel)
+        elif old_stat_key != stat_key:
+            modified.append(rel)
+        new.files[rel] = stat_key
+
+    stack = [('', os.stat(root).st_mtime_ns)]
+    while stack:
+        rel, mtime_ns = stack.pop()
+        old_dir = old.dirs.get(rel)
+        subdirs = []
+        files = []
+        if old_dir is not None and old_dir[0] == mtime_ns:
+            for name in old_dir[2]:
+                file_rel = os.path.join(rel, name)
+                if trust_dir_mtime:
+                    new.files[file_rel] = old.files[file_rel]
+                    files.append(name)
+                    continue
+                try:
+                    st = os.stat(root + file_rel)
+                except OSError:
+                    removed.append(file_rel)
+                else:
+                    check_file(file_rel, st)
+                    files.append(name)
+            for name in old_dir[1]:
+                try:
+                    st = os.stat(root + os.path.join(rel, name))
+                except OSError:
+                    removed.extend(old.subtree_files(os.path.join(rel, name)))
+                else:
+                    subdirs.append((name, st.st_mtime_ns))
+        else:
+            file_entries, dir_entries = _scan_dir(root + rel, True, False)
+            for entry in file_entries:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                check_file(os.path.join(rel, entry.name), st)
+                files.append(entry.name)
+            for entry in dir_entries:
+                if entry.is_symlink():
+                    continue
+                try:
+                    subdirs.append((entry.name, entry.stat().st_mtime_ns))
+                except OSError:
+                    pass
+            if old_dir is not None:
+                current = set(files)
+                removed.extend(os.path.join(rel, name) for name in old_dir[2] if name not in current)
+                current = {name for name, _ in subdirs}
+                for name in old_dir[1]:
+                    if name not in current:
+                        removed.extend(old.subtree_files(os.path.join(rel, name)))
+
+        new.dirs[rel] = (mtime_ns, tuple(name for name, _ in subdirs), tuple(files))
+        stack.extend((os.path.join(rel, name), sub_mtime_ns) for name, sub_mtime_ns in reversed(subdirs))
+
+    return FileChanges(added, modified, removed, new)
+
+
+def __getattr__(name):
+    # Module attributes that are expensive to create are created on first
+    # access.
+    if name == 'SIG_NAMES':
+        return _sig_names()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def _sig_names():
+    global SIG_NAMES
+    try:
+        return SIG_NAMES
+    except NameError:
+        SIG_NAMES = dict((k, v) for v, k in vars(signal._load()).items() if v.startswith('SIG'))
+        return SIG_NAMES
 
 
 def show_exit(exit_code):
@@ -257,153 +1798,143 @@ def show_exit(exit_code):
     if sig_num == 0:
         return "exit: {}".format(exit_status)
     else:
-        return "signal: {}".format(SIG_NAMES.get(sig_num, 'Unknown signal {}'.format(sig_num)))
+        return "signal: {}".format(_sig_names().get(sig_num, 'Unknown signal {}'.format(sig_num)))
 
 
-class TestUtil(unittest.TestCase):
+class JobResult:
+    """The result of a command run by run_parallel().
 
-    def test_chdir(self):
-        cur = os.getcwd()
-        with chdir('/'):
-            assert os.getcwd() == '/'
-        assert os.getcwd() == cur
+    `status` is the raw wait status, and `max_rss` is the peak resident
+    set size as reported by getrusage() (kilobytes on Linux). Times are
+    in seconds.
 
-    def test_dict_inverse(self):
-        assert dict_inverse({1: 'a', 2: 'a', 3: 'c'}) == {'a': [1, 2], 'c': [3]}
-        assert dict_inverse({1: 'a', 2: 'b', 3: 'c'}, True) == {'a': 1, 'b': 2, 'c': 3}
+    If the command could not be started, `error` is the OSError raised,
+    `pid` is None and `status` is exit status 127, as a shell reports
+    for a command that is not found.
 
-    def test_simplecontextmanager(self):
-        before = None
-        after = None
+    """
 
-        @simplecontextmanager
-        def foo():
-            nonlocal before
-            nonlocal after
-            after = None
-            before = True
-            yield 1
-            after = True
-
-        with foo() as x:
-            assert x == 1
-            assert before
-            assert after is None
-        assert before
-        assert after
+    __slots__ = ('index', 'args', 'pid', 'status', 'wall_time', 'user_time', 'system_time', 'max_rss', 'error')
 
-        try:
-            with foo() as x:
-                assert x == 1
-                assert before
-                assert after is None
-                raise Exception('check')
-        except Exception as exc:
-            assert exc.args == ('check', )
-            assert before
-            assert after
-        else:
-            assert False
+    def __init__(self, index, args, pid, status, wall_time, rusage=None, error=None):
+        self.index = index
+        self.args = args
+        self.pid = pid
+        self.status = status
+        self.wall_time = wall_time
+        self.user_time = rusage.ru_utime if rusage else 0.0
+        self.system_time = rusage.ru_stime if rusage else 0.0
+        self.max_rss = rusage.ru_maxrss if rusage else 0
+        self.error = error
 
-    def test_simplecontextmanager_double_yield(self):
-        before = None
-        after = None
+    @property
+    def cpu_time(self):
+        return self.user_time + self.system_time
 
-        @simplecontextmanager
-        def foo():
-            nonlocal before
-            nonlocal after
-            after = None
-            before = True
-            yield 1
-            yield 2
-            after = True
+    @property
+    def exit(self):
+        """A description of how the command exited, see show_exit()."""
+        if self.error is not None:
+            return "error: {}".format(self.error)
+        return show_exit(self.status)
 
-        try:
-            with foo() as x:
-                assert x == 1
-                assert before
-                assert after is None
-        except RuntimeError as exc:
-            assert exc.args == ("generator didn't stop", )
-        else:
-            assert False
+    def __repr__(self):
+        return "<JobResult {} {!r} {} wall={:.3f}s cpu={:.3f}s max_rss={}>".format(
+            self.index, self.args, self.exit, self.wall_time, self.cpu_time, self.max_rss)
 
-    def test_simplecontextmanager_raise(self):
-        before = None
-        after = None
 
-        @simplecontextmanager
-        def foo():
-            nonlocal before
-            nonlocal after
-            after = None
-            before = True
-            yield 1
-            raise Exception("with")
+def run_parallel(commands, jobs=None, env=None):
+    """Run `commands` (an iterable of argument lists), with up to `jobs`
+    (by default the number of CPUs) running at once.
 
-        try:
-            with foo() as x:
-                assert x == 1
-                assert before
-                assert after is None
-        except Exception as exc:
-            assert exc.args == ('with', )
-            assert before
-            assert after is None
-        else:
-            assert False
+    Generates a JobResult for each command as it finishes, which records
+    its exit status and resource usage. Commands are started with
+    os.posix_spawnp() with the environment `env` (by default
+    os.environ; an EnvOverlay works well here), and reaped with
+    os.wait4().
 
-        try:
-            with foo() as x:
-                assert x == 1
-                assert before
-                assert after is None
-                raise Exception("check")
-        except Exception as exc:
-            assert exc.args == ('check', )
-            assert before
-            assert after is None
-        else:
-            assert False
+    Only the commands' own processes are waited for, using pidfds where
+    the platform has them and polling otherwise, so this is safe to use
+    alongside other code that runs subprocesses.
 
-    def test_tempdir(self):
-        tempdir_name = None
-        with tempdir() as t:
-            tempdir_name = t
-            assert os.path.exists(tempdir_name)
+    A command that cannot be started, for example because it is not
+    found, does not stop the others: its JobResult has `error` set.
 
-        assert not os.path.exists(tempdir_name)
+    If the generator is closed early any commands still running are
+    killed.
 
-        try:
-            with tempdir() as t:
-                tempdir_name = t
-                assert os.path.exists(tempdir_name)
-                raise Exception('tempdir_with_fail')
-        except Exception as exc:
-            assert exc.args == ('tempdir_with_fail', )
-        else:
-            assert False
+    """
+    jobs = jobs or os.cpu_count()
+    if env is None:
+        env = os.environ
+    commands = enumerate(commands)
+    running = {}
+    selector = selectors.DefaultSelector() if hasattr(os, 'pidfd_open') else None
+
+    def reap(pid, options=0):
+        reaped_pid, status, rusage = os.wait4(pid, options)
+        if not reaped_pid:
+            return None
+        index, args, start, pidfd = running.pop(pid)
+        if pidfd is not None:
+            selector.unregister(pidfd)
+            os.close(pidfd)
+        return JobResult(index, args, pid, status, time.monotonic() - start, rusage)
+
+    try:
+        poll_delay = 0.0005
+        while True:
+            failed = []
+            for index, args in itertools.islice(commands, jobs - len(running)):
+                args = list(args)
+                start = time.monotonic()
+                try:
+                    pid = os.posix_spawnp(args[0], args, env)
+                except OSError as exc:
+                    failed.append(JobResult(index, args, None, 127 << 8, time.monotonic() - start, error=exc))
+                    continue
+                pidfd = None
+                if selector is not None:
+                    pidfd = os.pidfd_open(pid)
+                    selector.register(pidfd, selectors.EVENT_READ, pid)
+                running[pid] = (index, args, start, pidfd)
+            if failed:
+                yield from failed
+                continue
+            if not running:
+                break
+            if selector is not None:
+                for key, _ in selector.select():
+                    yield reap(key.data)
+            else:
+                results = [result for result in map(reap, list(running), itertools.repeat(os.WNOHANG)) if result]
+                if results:
+                    poll_delay = 0.0005
+                    yield from results
+                else:
+                    time.sleep(poll_delay)
+                    poll_delay = min(poll_delay * 2, 0.05)
+    finally:
+        for pid in list(running):
+            os.kill(pid, signal.SIGKILL)
+            reap(pid)
+        if selector is not None:
+            selector.close()
 
-        assert not os.path.exists(tempdir_name)
 
-    def test_file_list(self):
-        with tempdir() as t:
-            touch(os.path.join(t, 'b'))
-            touch(os.path.join(t, 'a'))
-            os.mkdir(os.path.join(t, 'c'))
-            touch(os.path.join(t, 'c', '1'))
-            assert list(file_list(t)) == ['a', 'b', 'c/1']
+_include_paths_cache = {}
 
-    def test_show_exit(self):
-        assert show_exit(os.system("exit 1")) == "exit: 1"
-        assert show_exit(os.system("exit 2")) == "exit: 2"
-        assert show_exit(os.system("kill -9 $$")) == "signal: SIGKILL"
 
+def _include_paths_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'pyutil', 'include-paths')
 
-def get_gcc_headers():
-    """Get the header locations."""
-    output = subprocess.check_output(["arm-none-eabi-cpp", "-Wp,-v"], stderr=subprocess.STDOUT, stdin=subprocess.PIPE).decode().splitlines()
+
+def _probe_include_paths(compiler, flags, language):
+    """Run `compiler` to find its include search paths."""
+    command = [compiler, '-E', '-v', '-x', language] + list(flags) + ['-']
+    output = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            check=True).stderr.decode().splitlines()
     start = False
     include_paths = []
     for line in output:
@@ -417,12 +1948,160 @@ def get_gcc_headers():
     return include_paths
 
 
+def probe_include_paths(compilers, flags=(), language='c', cache_dir=None, threads=None):
+    """Return a dictionary mapping each of `compilers` to its list of
+    system include search paths (the `#include <...>` search list).
+
+    `flags` are passed to each compiler (e.g. ['-mcpu=cortex-m4']) and
+    `language` is the language to probe for (e.g. 'c++').
+
+    Results are cached in memory and on disk in `cache_dir` (by default
+    $XDG_CACHE_HOME/pyutil/include-paths), keyed by the compiler's path,
+    size and mtime, `flags` and `language`, so a compiler is only run
+    again when it changes. Compilers that aren't cached are probed in
+    parallel on up to `threads` threads. If the disk cache can't be
+    written (e.g. a read-only home directory) results are only cached in
+    memory.
+
+    """
+    if cache_dir is None:
+        cache_dir = _include_paths_cache_dir()
+    flags = tuple(flags)
+    result = {}
+    misses = {}
+    for compiler in compilers:
+        path = shutil.which(compiler)
+        if path is None:
+            raise FileNotFoundError("Compiler not found: {}".format(compiler))
+        st = os.stat(path)
+        key = (os.path.realpath(path), st.st_size, st.st_mtime_ns, flags, language)
+        if key in _include_paths_cache:
+            result[compiler] = list(_include_paths_cache[key])
+            continue
+        cache_path = os.path.join(cache_dir, hashlib.sha256(repr(key).encode()).hexdigest() + '.json')
+        try:
+            with open(cache_path) as f:
+                include_paths = json.load(f)['include_paths']
+        except (OSError, ValueError, KeyError):
+            misses[compiler] = (path, key, cache_path)
+        else:
+            _include_paths_cache[key] = include_paths
+            result[compiler] = list(include_paths)
+
+    if misses:
+        with futures.ThreadPoolExecutor(threads) as executor:
+            probes = {compiler: executor.submit(_probe_include_paths, path, flags, language)
+                      for compiler, (path, _, _) in misses.items()}
+        for compiler, (path, key, cache_path) in misses.items():
+            include_paths = probes[compiler].result()
+            _include_paths_cache[key] = include_paths
+            result[compiler] = list(include_paths)
+            tmp_path = '{}.tmp{}'.format(cache_path, os.getpid())
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(tmp_path, 'w') as f:
+                    json.dump({'compiler': path, 'flags': flags, 'language': language,
+                               'include_paths': include_paths}, f)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp_path)
+
+    return result
+
+
+def get_include_paths(compiler, flags=(), language='c', cache_dir=None):
+    """Return the system include search paths of `compiler`, see
+    probe_include_paths().
+
+    """
+    return probe_include_paths([compiler], flags, language, cache_dir)[compiler]
+
+
+def get_gcc_headers():
+    """Get the header locations."""
+    return get_include_paths('arm-none-eabi-cpp')
+
+
 def range1(n):
     yield from range(1, n + 1)
 
 
+_debug_enabled = True
+_debug_quiet = False
+_debug_file = None
+_debug_ring = None
+_debug_dump_on_crash = False
+_debug_next_excepthook = None
+
+
+def configure_debug(enabled=True, file=None, quiet=False, ring_size=0, dump_on_crash=False):
+    """Configure debug().
+
+    If `enabled` is False debug() returns immediately, without looking
+    at its caller or formatting the message. Otherwise messages are
+    printed to `file` (by default stdout) unless `quiet` is True, and if
+    `ring_size` is non-zero the last `ring_size` messages are kept in
+    memory for debug_dump(). If `dump_on_crash` is True they are dumped
+    to stderr when the program exits with an uncaught exception.
+
+    """
+    global _debug_enabled, _debug_quiet, _debug_file, _debug_ring, _debug_dump_on_crash, _debug_next_excepthook
+    _debug_enabled = enabled
+    _debug_quiet = quiet
+    _debug_file = file
+    _debug_ring = collections.deque(maxlen=ring_size) if ring_size else None
+    _debug_dump_on_crash = dump_on_crash
+    if dump_on_crash and _debug_next_excepthook is None:
+        _debug_next_excepthook = sys.excepthook
+        sys.excepthook = _debug_excepthook
+
+
+def _debug_excepthook(*args):
+    """sys.excepthook installed by configure_debug(dump_on_crash=True)."""
+    if _debug_dump_on_crash:
+        debug_dump()
+    _debug_next_excepthook(*args)
+
+
+def debug_dump(file=None):
+    """Print the messages kept by debug() (see configure_debug()) to
+    `file`, by default stderr.
+
+    """
+    if _debug_ring is not None:
+        for msg in _debug_ring:
+            print(msg, file=sys.stderr if file is None else file)
+
+
+@functools.lru_cache(maxsize=1024)
+def _debug_fields(msg):
+    """Return whether `msg` refers to any variables."""
+    return any(field is not None for _, field, _, _ in string.Formatter().parse(msg))
+
+
 def debug(msg):
-    print(msg.format(**inspect.stack()[1][0].f_locals))
+    """Print `msg` formatted with the caller's local variables.
+
+    Example:
+
+    debug("x is {x}, y.z is {y.z}")
+
+    Only the caller's frame is looked at, and only if the message has
+    replacement fields. See configure_debug() to disable or redirect
+    the output.
+
+    """
+    if not _debug_enabled:
+        return
+    if _debug_fields(msg):
+        msg = msg.format_map(sys._getframe(1).f_locals)
+    else:
+        msg = msg.format()
+    if _debug_ring is not None:
+        _debug_ring.append(msg)
+    if not _debug_quiet:
+        print(msg, file=_debug_file)
 
 
 class SysExit(Exception):
@@ -432,18 +2111,94 @@ class SysExit(Exception):
         self.msg = msg
 
 
-def script():
-    s = inspect.stack()[1][0]
-    caller_name = s.f_locals['__name__']
+def _process_uptime():
+    """Return the seconds since this process started, or None if that
+    can't be determined (it relies on Linux's /proc).
+
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            fields = f.read().rpartition(')')[2].split()
+        start = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+_SCRIPT_PROFILE_MODES = ('cprofile', 'tracemalloc', 'time')
+
+
+def script(profile=None):
+    """Call the calling module's main() if the module is being run as a
+    script, and exit with its return value.
+
+    Typical usage, at the end of a script:
+
+        script()
+
+    `profile` is a comma separated string (or list) of profiling modes,
+    taken from the PYUTIL_PROFILE environment variable if not given:
+
+        cprofile: run main() under cProfile, and print the 30 functions
+          with the highest cumulative time to stderr, or save the stats
+          to the file named by PYUTIL_PROFILE_OUTPUT if set.
+        tracemalloc: trace memory allocations in main(), and print the
+          peak traced memory.
+        time: print the wall-clock time from process start to calling
+          script() (i.e. interpreter start-up and imports), and of main().
+
+    """
+    caller_locals = sys._getframe(1).f_locals
+    caller_name = caller_locals['__name__']
     if caller_name != '__main__':
         return
 
-    caller_main = s.f_locals.get('main')
+    caller_main = caller_locals.get('main')
     if caller_main is None:
         print("main() not found.", file=sys.stderr)
         sys.exit(1)
+
+    if profile is None:
+        profile = os.environ.get('PYUTIL_PROFILE', '')
+    if isinstance(profile, str):
+        profile = profile.split(',')
+    profile = {mode.strip() for mode in profile if mode.strip()}
+    for mode in profile - set(_SCRIPT_PROFILE_MODES):
+        print("Unknown profile mode '{}' (expected one of: {})".format(mode, ', '.join(_SCRIPT_PROFILE_MODES)),
+              file=sys.stderr)
+    if not profile:
+        _run_main(caller_main)
+
+    startup_time = _process_uptime()
+    profiler = None
+    if 'cprofile' in profile:
+        profiler = cProfile.Profile()
+        caller_main = functools.partial(profiler.runcall, caller_main)
+    if 'tracemalloc' in profile:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        _run_main(caller_main)
+    finally:
+        main_time = time.perf_counter() - start
+        if 'tracemalloc' in profile:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("script: peak traced memory: {:.1f} KiB".format(peak / 1024), file=sys.stderr)
+        if 'time' in profile:
+            startup = 'unknown' if startup_time is None else '{:.3f}s'.format(startup_time)
+            print("script: start-up: {}, main(): {:.3f}s".format(startup, main_time), file=sys.stderr)
+        if profiler is not None:
+            output = os.environ.get('PYUTIL_PROFILE_OUTPUT')
+            if output:
+                profiler.dump_stats(output)
+            else:
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
+
+
+def _run_main(main):
     try:
-        sys.exit(caller_main())
+        sys.exit(main())
     except SysExit as e:
         if e.msg:
             print(e.msg, file=sys.stderr)
@@ -460,6 +2215,78 @@ def camelify(name):
     return ''.join([i.capitalize() for i in name.split('_')])
 
 
+_WORD_BOUNDARY_RE = re.compile(r'(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])')
+
+
+def snakify(name):
+    """Change from FooBar => foo_bar, the inverse of camelify()"""
+    return _WORD_BOUNDARY_RE.sub('_', name).lower()
+
+
+def convert_keys(obj, convert):
+    """Return a copy of a tree of dicts and lists or tuples, such as
+    decoded JSON, with each string key of the dicts changed to
+    convert(key). Tuples are copied as lists, as JSON has no tuples.
+
+    """
+    containers = (dict, list, tuple)
+    if isinstance(obj, dict):
+        return {convert(k) if isinstance(k, str) else k: convert_keys(v, convert) if isinstance(v, containers) else v
+                for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [convert_keys(v, convert) if isinstance(v, containers) else v for v in obj]
+    return obj
+
+
+class KeyCaseCodec:
+    """Converts names between snake_case and CamelCase, caching up to
+    `maxsize` conversions in each direction, for repeatedly converting
+    the keys of large payloads. The results are exactly those of
+    camelify() and snakify().
+
+    Example:
+
+    > codec = KeyCaseCodec()
+    > codec.to_camel({'user_id': 1, 'tags': [{'tag_name': 'x'}]})
+    {'UserId': 1, 'Tags': [{'TagName': 'x'}]}
+
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._camel = {}
+        self._snake = {}
+
+    def _convert(self, name, cache, fn):
+        converted = fn(name)
+        if len(cache) >= self.maxsize:
+            cache.clear()
+        cache[name] = converted
+        return converted
+
+    def camel(self, name):
+        """Return camelify(name), cached."""
+        try:
+            return self._camel[name]
+        except KeyError:
+            return self._convert(name, self._camel, camelify)
+
+    def snake(self, name):
+        """Return snakify(name), cached."""
+        try:
+            return self._snake[name]
+        except KeyError:
+            return self._convert(name, self._snake, snakify)
+
+    def to_camel(self, obj):
+        """Return convert_keys(obj) with the keys changed to CamelCase."""
+        return convert_keys(obj, self.camel)
+
+    def to_snake(self, obj):
+        """Return convert_keys(obj) with the keys changed to snake_case."""
+        return convert_keys(obj, self.snake)
+
+
 def yield_until_exception(exception, fn):
     """Generate values be repeatedly calling fn() until the specified exception
     is raised.
@@ -472,6 +2299,140 @@ def yield_until_exception(exception, fn):
             break
 
 
+def yield_until_exception_prefetch(exception, fn, prefetch=16, batch=None):
+    """Like yield_until_exception(), but calls fn() repeatedly on a
+    background thread, so that producing values overlaps with consuming
+    them.
+
+    Up to `prefetch` values are read ahead. If `batch` is given, lists of
+    up to `batch` values are generated instead of single values, and up
+    to `prefetch` lists are read ahead. Both must be at least 1. Any
+    other exception raised by fn() is raised by the generator after the
+    values produced before it. If the generator is closed early the
+    thread stops once its current call to fn() returns.
+
+    """
+    if prefetch < 1:
+        raise ValueError("prefetch must be at least 1")
+    if batch is not None and batch < 1:
+        raise ValueError("batch must be at least 1")
+    values = queue.Queue(prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up if the consumer has gone away while the queue is full.
+        while not stop.is_set():
+            try:
+                values.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        # Queue (False, value) for each value and (True, error) at the end.
+        items = []
+        error = None
+        try:
+            while not stop.is_set():
+                try:
+                    value = fn()
+                except exception:
+                    break
+                if batch is None:
+                    put((False, value))
+                else:
+                    items.append(value)
+                    if len(items) == batch:
+                        put((False, items))
+                        items = []
+        except BaseException as exc:
+            error = exc
+        if items:
+            put((False, items))
+        put((True, error))
+
+    thread = threading.Thread(target=produce, name='yield_until_exception_prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            done, value = values.get()
+            if done:
+                thread.join()
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        stop.set()
+
+
+async def async_yield_until_exception(exception, fn, prefetch=0, batch=None):
+    """An asynchronous generator counterpart of yield_until_exception(),
+    for a coroutine function fn().
+
+    If `prefetch` is non-zero fn() is awaited in a separate task, so that
+    up to `prefetch` values (or lists of values) are read ahead; unlike
+    yield_until_exception_prefetch(), the default of 0 means nothing is
+    read ahead. `batch` is as for yield_until_exception_prefetch().
+
+    """
+    if prefetch < 0:
+        raise ValueError("prefetch must not be negative")
+    if batch is not None and batch < 1:
+        raise ValueError("batch must be at least 1")
+
+    async def generate():
+        items = []
+        try:
+            while True:
+                try:
+                    value = await fn()
+                except exception:
+                    break
+                if batch is None:
+                    yield value
+                else:
+                    items.append(value)
+                    if len(items) == batch:
+                        yield items
+                        items = []
+        except Exception:
+            if items:
+                yield items
+            raise
+        if items:
+            yield items
+
+    if not prefetch:
+        async for value in generate():
+            yield value
+        return
+
+    values = asyncio.Queue(prefetch)
+
+    async def produce():
+        # Queue (False, value) for each value and (True, error) at the end.
+        try:
+            async for value in generate():
+                await values.put((False, value))
+        except Exception as exc:
+            await values.put((True, exc))
+        else:
+            await values.put((True, None))
+
+    task = asyncio.ensure_future(produce())
+    try:
+        while True:
+            done, value = await values.get()
+            if done:
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        task.cancel()
+
+
 def attr_dict(itr, attr):
     """Given an iterable create a dictionary of the values indexed by a named attribute."""
     return {getattr(x, attr): x for x in itr}
@@ -503,19 +2464,273 @@ class frozendict(dict):
     def __new__(cls, *args):
         new = dict.__new__(cls)
         dict.__init__(new, *args)
-        new._hash = hash(frozenset(new.items()))
+        # Computed on the first call to __hash__.
+        new._hash = None
         return new
 
     def __init__(self, *args):
         pass
 
     def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self.items()))
         return self._hash
 
     def __repr__(self):
         return "frozendict(%s)" % dict.__repr__(self)
 
 
+_popcount = getattr(int, 'bit_count', None) or (lambda n: bin(n).count('1'))
+
+
+class _HamtNode:
+    """A node of a frozenmap's trie, holding the entries of the keys whose
+    hashes share the same first `shift` bits. `bitmap` has a bit set for
+    each of the 32 values of the next 5 bits that is in use, and
+    `entries` has an entry for each, in order: a (hash, key, value) leaf,
+    or a _HamtNode or _HamtCollision for several keys.
+
+    """
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+class _HamtCollision:
+    """The (hash, key, value) leaves of keys with identical hashes."""
+    __slots__ = ('hash', 'entries')
+
+    def __init__(self, hash, entries):
+        self.hash = hash
+        self.entries = entries
+
+
+def _hamt_merge(shift, leaf1, leaf2):
+    """Return a node holding two leaves with different keys."""
+    if leaf1[0] == leaf2[0]:
+        return _HamtCollision(leaf1[0], (leaf1, leaf2))
+    idx1 = (leaf1[0] >> shift) & 31
+    idx2 = (leaf2[0] >> shift) & 31
+    if idx1 == idx2:
+        return _HamtNode(1 << idx1, (_hamt_merge(shift + 5, leaf1, leaf2), ))
+    if idx1 > idx2:
+        leaf1, leaf2 = leaf2, leaf1
+    return _HamtNode((1 << idx1) | (1 << idx2), (leaf1, leaf2))
+
+
+def _hamt_set(node, shift, leaf):
+    """Return (node with `leaf` set, whether its key was added)."""
+    h, key, value = leaf
+    if isinstance(node, _HamtCollision):
+        if h != node.hash:
+            # Move the collision down a level to make room for `leaf`.
+            node = _HamtNode(1 << ((node.hash >> shift) & 31), (node, ))
+            return _hamt_set(node, shift, leaf)
+        for idx, entry in enumerate(node.entries):
+            if entry[1] is key or entry[1] == key:
+                if entry[2] is value:
+                    return node, False
+                return _HamtCollision(h, node.entries[:idx] + (leaf, ) + node.entries[idx + 1:]), False
+        return _HamtCollision(h, node.entries + (leaf, )), True
+
+    bit = 1 << ((h >> shift) & 31)
+    idx = _popcount(node.bitmap & (bit - 1))
+    entries = node.entries
+    if not node.bitmap & bit:
+        return _HamtNode(node.bitmap | bit, entries[:idx] + (leaf, ) + entries[idx:]), True
+    entry = entries[idx]
+    if type(entry) is tuple:
+        if entry[0] == h and (entry[1] is key or entry[1] == key):
+            if entry[2] is value:
+                return node, False
+            new_entry, added = leaf, False
+        else:
+            new_entry, added = _hamt_merge(shift + 5, entry, leaf), True
+    else:
+        new_entry, added = _hamt_set(entry, shift + 5, leaf)
+        if new_entry is entry:
+            return node, False
+    return _HamtNode(node.bitmap, entries[:idx] + (new_entry, ) + entries[idx + 1:]), added
+
+
+def _hamt_delete(node, shift, h, key):
+    """Return `node` with `key` removed: the same node if `key` is not
+    present, None if it is then empty, or a leaf if only that remains.
+
+    """
+    if isinstance(node, _HamtCollision):
+        if h != node.hash:
+            return node
+        for idx, entry in enumerate(node.entries):
+            if entry[1] is key or entry[1] == key:
+                entries = node.entries[:idx] + node.entries[idx + 1:]
+                return entries[0] if len(entries) == 1 else _HamtCollision(h, entries)
+        return node
+
+    bit = 1 << ((h >> shift) & 31)
+    if not node.bitmap & bit:
+        return node
+    idx = _popcount(node.bitmap & (bit - 1))
+    entries = node.entries
+    entry = entries[idx]
+    if type(entry) is tuple:
+        if entry[0] != h or not (entry[1] is key or entry[1] == key):
+            return node
+        new_entry = None
+    else:
+        new_entry = _hamt_delete(entry, shift + 5, h, key)
+        if new_entry is entry:
+            return node
+
+    if new_entry is not None:
+        if len(entries) == 1 and type(new_entry) is tuple:
+            return new_entry
+        return _HamtNode(node.bitmap, entries[:idx] + (new_entry, ) + entries[idx + 1:])
+    entries = entries[:idx] + entries[idx + 1:]
+    if not entries:
+        return None
+    if len(entries) == 1 and type(entries[0]) is tuple:
+        return entries[0]
+    return _HamtNode(node.bitmap & ~bit, entries)
+
+
+def _hamt_leaves(node):
+    for entry in node.entries:
+        if type(entry) is tuple:
+            yield entry
+        else:
+            yield from _hamt_leaves(entry)
+
+
+_HAMT_EMPTY = _HamtNode(0, ())
+
+
+class frozenmap(collections.abc.Mapping):
+    """An immutable mapping that can be cheaply changed into a new mapping.
+
+    set(), delete() and update() return a new frozenmap that shares all
+    but O(log n) of its structure with the old one, unlike copying a
+    frozendict. It is stored as a hash array mapped trie (HAMT). Like
+    frozendict, it is hashable if its values are.
+
+    Example:
+
+    > config = frozenmap(debug=False, jobs=4)
+    > config.set('jobs', 8)
+    frozenmap({'debug': False, 'jobs': 8})
+    > config['jobs']
+    4
+
+    """
+    __slots__ = ('_root', '_len', '_hash')
+
+    def __init__(self, *args, **kwargs):
+        self._root = _HAMT_EMPTY
+        self._len = 0
+        self._hash = None
+        if args or kwargs:
+            self._root, self._len = self._updated(dict(*args, **kwargs).items())
+
+    @classmethod
+    def _new(cls, root, length):
+        new = cls.__new__(cls)
+        new._root = root
+        new._len = length
+        new._hash = None
+        return new
+
+    def _updated(self, items):
+        root, length = self._root, self._len
+        for key, value in items:
+            root, added = _hamt_set(root, 0, (hash(key) & 0xffffffffffffffff, key, value))
+            length += added
+        return root, length
+
+    def __getitem__(self, key):
+        h = hash(key) & 0xffffffffffffffff
+        node = self._root
+        shift = 0
+        while True:
+            if isinstance(node, _HamtCollision):
+                if node.hash == h:
+                    for entry in node.entries:
+                        if entry[1] is key or entry[1] == key:
+                            return entry[2]
+                raise KeyError(key)
+            bit = 1 << ((h >> shift) & 31)
+            if not node.bitmap & bit:
+                raise KeyError(key)
+            node = node.entries[_popcount(node.bitmap & (bit - 1))]
+            if type(node) is tuple:
+                if node[0] == h and (node[1] is key or node[1] == key):
+                    return node[2]
+                raise KeyError(key)
+            shift += 5
+
+    def __iter__(self):
+        return (leaf[1] for leaf in _hamt_leaves(self._root))
+
+    def __len__(self):
+        return self._len
+
+    def items(self):
+        return _FrozenMapItems(self)
+
+    def values(self):
+        return _FrozenMapValues(self)
+
+    def set(self, key, value):
+        """Return a copy of this map with `key` set to `value`."""
+        root, length = self._updated(((key, value), ))
+        return self if root is self._root else self._new(root, length)
+
+    def delete(self, key):
+        """Return a copy of this map without `key`, raising KeyError if it
+        is not present.
+
+        """
+        root = _hamt_delete(self._root, 0, hash(key) & 0xffffffffffffffff, key)
+        if root is self._root:
+            raise KeyError(key)
+        if root is None:
+            root = _HAMT_EMPTY
+        elif type(root) is tuple:
+            root = _HamtNode(1 << (root[0] & 31), (root, ))
+        return self._new(root, self._len - 1)
+
+    def update(self, *args, **kwargs):
+        """Return a copy of this map updated as dict.update() would."""
+        root, length = self._updated(dict(*args, **kwargs).items())
+        return self if root is self._root else self._new(root, length)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self.items()))
+        return self._hash
+
+    def __reduce__(self):
+        return frozenmap, (dict(self.items()), )
+
+    def __repr__(self):
+        return "frozenmap(%r)" % dict(self.items())
+
+
+class _FrozenMapItems(collections.abc.ItemsView):
+    __slots__ = ()
+
+    def __iter__(self):
+        return ((leaf[1], leaf[2]) for leaf in _hamt_leaves(self._mapping._root))
+
+
+class _FrozenMapValues(collections.abc.ValuesView):
+    __slots__ = ()
+
+    def __iter__(self):
+        return (leaf[2] for leaf in _hamt_leaves(self._mapping._root))
+
+
 def split_inclusive(lst, condition):
     start = 0
     for idx in range(len(lst)):
@@ -525,12 +2740,74 @@ def split_inclusive(lst, condition):
     yield lst[start:]
 
 
+def split_inclusive_iter(itr, condition):
+    """Like split_inclusive(), but for any iterable, generating the chunks
+    as lists without first reading all of `itr`.
+
+    """
+    chunk = []
+    for v in itr:
+        if condition(v):
+            yield chunk
+            chunk = [v]
+        else:
+            chunk.append(v)
+    yield chunk
+
+
+def split_inclusive_views(data, mask):
+    """Like split_inclusive(), but for a numpy array or an object
+    supporting the buffer protocol (such as bytes), generating views of
+    `data` instead of copies: array slices for an array, and memoryview
+    slices otherwise.
+
+    A new chunk starts at each index where `mask` is true. `mask` is a
+    sequence of booleans as long as `data`, or a callable that is called
+    once with `data` and returns one, for example
+    lambda a: a == ord('\\n') for a numpy array of bytes. With numpy the
+    boundaries are found with numpy.flatnonzero().
+
+    """
+    np = _numpy()
+    view = data if np is not None and isinstance(data, np.ndarray) else memoryview(data)
+    if callable(mask):
+        mask = mask(data)
+    if np is not None:
+        bounds = np.flatnonzero(np.asarray(mask, dtype=bool)).tolist()
+    else:
+        bounds = [idx for idx, boundary in enumerate(mask) if boundary]
+    start = 0
+    for idx in bounds:
+        yield view[start:idx]
+        start = idx
+    yield view[start:]
+
+
 def tuple_gen(obj, name_x, name_y):
     for x in getattr(obj, name_x):
         for y in getattr(x, name_y):
             yield x, y
 
 
+def tuple_gen_nested(obj, *names):
+    """Generalise tuple_gen() to any number of levels, generating a tuple
+    (x, y, z, ...) for each x in obj.<names[0]>, y in x.<names[1]>, z in
+    y.<names[2]> and so on.
+
+    """
+    def gen(parent, idx, prefix):
+        last = idx == len(names) - 1
+        for child in getattr(parent, names[idx]):
+            if last:
+                yield prefix + (child, )
+            else:
+                yield from gen(child, idx + 1, prefix + (child, ))
+
+    if not names:
+        return iter(())
+    return gen(obj, 0, ())
+
+
 def dict_grouped_by_key(itr, key):
     d = {}
     for v in itr:
@@ -538,15 +2815,583 @@ def dict_grouped_by_key(itr, key):
     return d
 
 
+def _getter(key):
+    """Return `key` if it is callable, otherwise a function that gets the
+    attribute named `key`. None gives the identity function.
+
+    """
+    if key is None:
+        return lambda v: v
+    if callable(key):
+        return key
+    return operator.attrgetter(key)
+
+
+_GROUP_AGGREGATES = {
+    # operation: (initial state from the first value, state updated with a value)
+    'count': (lambda v: 1, lambda state, v: state + 1),
+    'sum': (lambda v: v, lambda state, v: state + v),
+    'min': (lambda v: v, lambda state, v: v if v < state else state),
+    'max': (lambda v: v, lambda state, v: v if v > state else state),
+    'first': (lambda v: v, lambda state, v: state),
+    'list': (lambda v: [v], lambda state, v: state.append(v) or state),
+}
+
+
+def group_by(itr, keys, aggregates=None):
+    """Group the items of `itr` by several keys at once, in a single pass.
+
+    `keys` is a dictionary mapping a name for each grouping to its key,
+    which is a function or the name of an attribute.
+
+    If `aggregates` is None each group is a list of its items, as with
+    dict_grouped_by_key(). Otherwise each group is a dictionary of
+    aggregate values, and the items themselves are not kept, so memory
+    use depends on the number of groups rather than the number of items.
+    `aggregates` maps a name for each aggregate to an operation, one of
+    'count', 'sum', 'min', 'max', 'first' or 'list', or to a tuple of
+    (operation, value) where value is a function or attribute name
+    applied to the item first.
+
+    Returns a dictionary mapping each grouping's name to a dictionary of
+    its groups.
+
+    Example:
+
+    > group_by(files, {'ext': 'ext', 'owner': 'owner'}, {'n': 'count', 'size': ('sum', 'size')})
+    {'ext': {'.py': {'n': 2, 'size': 300}, '.c': {'n': 1, 'size': 50}},
+     'owner': {'root': {'n': 3, 'size': 350}}}
+
+    """
+    groupings = {name: {} for name in keys}
+    key_fns = [(_getter(key), groupings[name]) for name, key in keys.items()]
+
+    if aggregates is None:
+        for v in itr:
+            for key_fn, groups in key_fns:
+                groups.setdefault(key_fn(v), []).append(v)
+        return groupings
+
+    names = []
+    value_fns = []
+    inits = []
+    updates = []
+    for name, aggregate in aggregates.items():
+        operation, value = (aggregate, None) if isinstance(aggregate, str) else aggregate
+        if operation not in _GROUP_AGGREGATES:
+            raise ValueError("Unknown aggregate operation: {}".format(operation))
+        init, update = _GROUP_AGGREGATES[operation]
+        names.append(name)
+        value_fns.append(_getter(value))
+        inits.append(init)
+        updates.append(update)
+
+    for v in itr:
+        # Aggregated values are computed once per item, not per grouping.
+        values = [value_fn(v) for value_fn in value_fns]
+        for key_fn, groups in key_fns:
+            k = key_fn(v)
+            state = groups.get(k)
+            if state is None:
+                groups[k] = [init(value) for init, value in zip(inits, values)]
+            else:
+                for idx, update in enumerate(updates):
+                    state[idx] = update(state[idx], values[idx])
+
+    for groups in groupings.values():
+        for k, state in groups.items():
+            groups[k] = dict(zip(names, state))
+    return groupings
+
+
 def find_duplicates_by_key(itr, key):
     kv = dict_grouped_by_key(itr, key)
     return {k: v for k, v in kv.items() if len(v) > 1}
 
 
-def remove_duplicates_by_key(itr, key):
-    seen = set()
+def hash_join(left, right, key, right_key=None, how='inner'):
+    """Join the items of `left` and `right` whose keys are equal, without
+    comparing every pair.
+
+    `key` is a function or the name of an attribute giving the key of an
+    item of `left`, and `right_key` the same for `right` (by default the
+    same as `key`). `how` is one of:
+
+    * 'inner': generate (l, r) for each pair with equal keys.
+    * 'left': as 'inner', and also (l, None) for each l without a match.
+    * 'semi': generate each l that has a match in `right`.
+    * 'anti': generate each l that has no match in `right`.
+
+    An index of one side is built in memory while the other side is read
+    as a stream. That is normally `right`, which makes the result follow
+    the order of `left`, but if both sides have a length and `left` is
+    the shorter then `left` is indexed instead and the order is not
+    defined. Use tuple_gen() or tuple_gen_nested() to join nested items.
+
+    Example:
+
+    > list(hash_join(users, orders, 'id', 'user_id', how='anti'))
+    [<User without orders>, ...]
+
+    """
+    if how not in ('inner', 'left', 'semi', 'anti'):
+        raise ValueError("Unknown join type: {}".format(how))
+    left_fn = _getter(key)
+    right_fn = left_fn if right_key is None else _getter(right_key)
+
+    if (isinstance(left, collections.abc.Sized) and isinstance(right, collections.abc.Sized)
+            and len(left) < len(right)):
+        return _hash_join_indexing_left(left, right, left_fn, right_fn, how)
+    return _hash_join_indexing_right(left, right, left_fn, right_fn, how)
+
+
+def _hash_join_indexing_right(left, right, left_fn, right_fn, how):
+    if how in ('semi', 'anti'):
+        keys = set(map(right_fn, right))
+        want = how == 'semi'
+        for l in left:
+            if (left_fn(l) in keys) == want:
+                yield l
+        return
+
+    index = {}
+    for r in right:
+        index.setdefault(right_fn(r), []).append(r)
+    for l in left:
+        matches = index.get(left_fn(l))
+        if matches:
+            for r in matches:
+                yield l, r
+        elif how == 'left':
+            yield l, None
+
+
+def _hash_join_indexing_left(left, right, left_fn, right_fn, how):
+    index = {}
+    for l in left:
+        index.setdefault(left_fn(l), []).append(l)
+
+    if how == 'inner':
+        for r in right:
+            for l in index.get(right_fn(r), ()):
+                yield l, r
+        return
+
+    matched = set()
+    for r in right:
+        k = right_fn(r)
+        if k in index:
+            matched.add(k)
+            if how == 'left':
+                for l in index[k]:
+                    yield l, r
+    for k, ls in index.items():
+        if how == 'semi':
+            if k in matched:
+                yield from ls
+        elif k not in matched:
+            yield from ((l, None) for l in ls) if how == 'left' else ls
+
+
+# The most sorted runs find_duplicates_by_key_external() merges at once.
+_MERGE_FAN_IN = 64
+
+
+def _write_run(items, dir):
+    run = tempfile.TemporaryFile(dir=dir)
+    pickler = pickle.Pickler(run, pickle.HIGHEST_PROTOCOL)
+    for item in items:
+        pickler.dump(item)
+        # The pickler's memo would otherwise hold on to every item.
+        pickler.clear_memo()
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    unpickler = pickle.Unpickler(run)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
+
+
+def find_duplicates_by_key_external(itr, key, memory_limit=64 * 2**20, dir=None):
+    """Generate (key, records) for each key(record) shared by more than one
+    of the records in `itr`, like find_duplicates_by_key() but for inputs
+    too large to fit in memory.
+
+    Records are pickled and buffered until they take about `memory_limit`
+    bytes, then sorted by key and written out as a run to a temporary
+    file (in `dir`, if given). The runs are merged to produce the groups
+    in key order, with the records of each group in input order. Keys
+    must be orderable and records picklable; each group of duplicates is
+    loaded into memory when it is generated.
+
+    """
+    first = operator.itemgetter(0)
+    runs = []
+    buffer = []
+    size = 0
+    try:
+        for record in itr:
+            k = key(record)
+            blob = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+            buffer.append((k, blob))
+            size += len(blob) + sys.getsizeof(k) + 64
+            if size >= memory_limit:
+                buffer.sort(key=first)
+                runs.append(_write_run(buffer, dir))
+                buffer = []
+                size = 0
+        buffer.sort(key=first)
+
+        # Merge consecutive runs, keeping them in input order, until the
+        # final merge only needs a bounded number of open files.
+        while len(runs) > _MERGE_FAN_IN:
+            merged_runs = []
+            for idx in range(0, len(runs), _MERGE_FAN_IN):
+                batch = runs[idx:idx + _MERGE_FAN_IN]
+                merged_runs.append(_write_run(heapq.merge(*map(_read_run, batch), key=first), dir))
+                for run in batch:
+                    run.close()
+            runs = merged_runs
+
+        merged = heapq.merge(*map(_read_run, runs), buffer, key=first)
+        for k, group in itertools.groupby(merged, first):
+            blobs = [blob for _, blob in group]
+            if len(blobs) > 1:
+                yield k, [pickle.loads(blob) for blob in blobs]
+    finally:
+        for run in runs:
+            run.close()
+
+
+def remove_duplicates_by_key(itr, key, seen=None):
+    """Generate the items of `itr`, skipping those whose key(item) has
+    already been seen.
+
+    By default every key is remembered in a set, which grows without
+    bound. For long streams pass one of LRUSeen, BloomSeen or
+    SpillingSeen as `seen` to bound the memory used.
+
+    """
+    if seen is None:
+        seen = set()
+        for v in itr:
+            k = key(v)
+            if k not in seen:
+                yield v
+                seen.add(k)
+        return
+
     for v in itr:
-        k = key(v)
-        if k not in seen:
+        if seen.add(key(v)):
             yield v
-            seen.add(k)
+
+
+class _Seen:
+    """Base class of the remove_duplicates_by_key() `seen` strategies.
+
+    Subclasses provide add(key), which records `key` and returns True if
+    it had not been seen before, and memory_usage(), which returns the
+    approximate number of bytes of memory used. `lookups` and `hits`
+    count the calls to add() and those that found a key already seen.
+
+    """
+
+    def __init__(self):
+        self.lookups = 0
+        self.hits = 0
+
+    @property
+    def hit_rate(self):
+        """The fraction of keys that had already been seen."""
+        return self.hits / self.lookups if self.lookups else 0.0
+
+
+class LRUSeen(_Seen):
+    """Remembers only the `maxsize` most recently seen keys.
+
+    This is exact for duplicates that occur within a window of `maxsize`
+    distinct keys; older keys are forgotten and will be seen as new.
+
+    """
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+        self._keys = collections.OrderedDict()
+
+    def add(self, key):
+        self.lookups += 1
+        keys = self._keys
+        if key in keys:
+            keys.move_to_end(key)
+            self.hits += 1
+            return False
+        keys[key] = None
+        if len(keys) > self.maxsize:
+            keys.popitem(last=False)
+        return True
+
+    def memory_usage(self):
+        return sys.getsizeof(self._keys) + sum(map(sys.getsizeof, self._keys))
+
+
+class BloomSeen(_Seen):
+    """Remembers keys in a Bloom filter sized for `capacity` keys with a
+    false positive rate of `error_rate`.
+
+    Memory is fixed, but a new key is wrongly treated as seen (and so
+    dropped) with probability `error_rate`, rising if more than
+    `capacity` keys are added. The bit positions come from a blake2b
+    digest of the key (its encoding for str, bytes and int keys, and
+    otherwise its pickle), not hash(), so keys with equal hashes don't
+    always collide. As for SpillingSeen, keys must pickle identically
+    when they are equal.
+
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        super().__init__()
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    @staticmethod
+    def _encode(key):
+        # Each encoding is tagged by type, so that e.g. 'a' and b'a' differ.
+        if isinstance(key, str):
+            return b's' + key.encode('utf-8', 'surrogatepass')
+        if isinstance(key, bytes):
+            return b'b' + key
+        if isinstance(key, int):
+            return b'i' + key.to_bytes(key.bit_length() // 8 + 1, 'little', signed=True)
+        return b'p' + pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+
+    def add(self, key):
+        self.lookups += 1
+        # Derive the bit positions from two 64-bit halves of the digest by
+        # double hashing.
+        digest = hashlib.blake2b(self._encode(key), digest_size=16).digest()
+        z = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        bits = self._bits
+        new = False
+        for _ in range(self.num_hashes):
+            bit = z % self.num_bits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                new = True
+            z += step
+        if not new:
+            self.hits += 1
+        return new
+
+    def memory_usage(self):
+        return sys.getsizeof(self._bits)
+
+
+class SpillingSeen(_Seen):
+    """Remembers every key exactly, keeping at most `max_keys` of them in
+    memory and spilling the rest to an SQLite database in a temporary
+    file (in `dir`, if given).
+
+    Spilled keys are stored pickled, so keys must pickle identically when
+    they are equal (true of str, bytes, int and tuples of them, for
+    example). Call close(), or use as a context manager, to remove the
+    temporary file.
+
+    """
+
+    def __init__(self, max_keys, dir=None):
+        super().__init__()
+        self.max_keys = max_keys
+        self.dir = dir
+        self.spilled = 0
+        self._keys = set()
+        self._db = None
+        self._db_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _spill(self):
+        if self._db is None:
+            fd, self._db_path = tempfile.mkstemp(suffix='.sqlite', dir=self.dir)
+            os.close(fd)
+            self._db = sqlite3.connect(self._db_path)
+            self._db.execute('PRAGMA journal_mode = OFF')
+            self._db.execute('PRAGMA synchronous = OFF')
+            self._db.execute('CREATE TABLE seen (key BLOB PRIMARY KEY) WITHOUT ROWID')
+        self._db.executemany('INSERT OR IGNORE INTO seen VALUES (?)',
+                             ((pickle.dumps(key, pickle.HIGHEST_PROTOCOL), ) for key in self._keys))
+        self._db.commit()
+        self.spilled += len(self._keys)
+        self._keys.clear()
+
+    def add(self, key):
+        self.lookups += 1
+        if key in self._keys:
+            self.hits += 1
+            return False
+        if self._db is not None:
+            blob = pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
+            if self._db.execute('SELECT 1 FROM seen WHERE key = ?', (blob, )).fetchone():
+                self.hits += 1
+                return False
+        self._keys.add(key)
+        if len(self._keys) >= self.max_keys:
+            self._spill()
+        return True
+
+    def memory_usage(self):
+        return sys.getsizeof(self._keys) + sum(map(sys.getsizeof, self._keys))
+
+    def disk_usage(self):
+        """Return the size in bytes of the spilled keys' database."""
+        return os.path.getsize(self._db_path) if self._db_path else 0
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            os.unlink(self._db_path)
+            self._db = None
+            self._db_path = None
+
+
+class DuplicateFileFinder:
+    """Find files with identical contents.
+
+    Rather than hashing every file in full, files are first grouped by
+    size, then groups are narrowed by a hash of just the first and last
+    `block_size` bytes, and only the files still in a group are hashed
+    in full. Hashing is done on a pool of `threads` threads reading the
+    files through mmap.
+
+    The counters `files`, `candidates`, `hashed` and `bytes_read` may be
+    read from another thread to monitor progress, along with `elapsed`
+    and `throughput`. They are reset at the start of each find():
+
+        files: files found
+        candidates: files sharing a size with another file
+        hashed: files hashed (partially or in full)
+        bytes_read: bytes hashed
+
+    """
+
+    def __init__(self, threads=None, block_size=64 * 1024, hash_name='blake2b'):
+        self.threads = threads or os.cpu_count()
+        self.block_size = block_size
+        self.hash_name = hash_name
+        self.files = 0
+        self.candidates = 0
+        self.hashed = 0
+        self.bytes_read = 0
+        self._start_time = None
+        self._end_time = None
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        """Seconds spent in the latest find(), so far."""
+        if self._start_time is None:
+            return 0.0
+        return (self._end_time or time.monotonic()) - self._start_time
+
+    @property
+    def throughput(self):
+        """Bytes hashed per second, so far."""
+        elapsed = self.elapsed
+        return self.bytes_read / elapsed if elapsed else 0.0
+
+    def _hash(self, path, partial):
+        """Return a hash of the file `path`, or None if it can't be read.
+
+        If `partial` is True only the first and last blocks are hashed.
+
+        """
+        digest = hashlib.new(self.hash_name)
+        try:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    if partial and len(view) > 2 * self.block_size:
+                        chunks = [view[:self.block_size], view[-self.block_size:]]
+                    else:
+                        chunk_size = 16 * self.block_size
+                        chunks = (view[idx:idx + chunk_size] for idx in range(0, len(view), chunk_size))
+                    for chunk in chunks:
+                        digest.update(chunk)
+                        with self._lock:
+                            self.bytes_read += len(chunk)
+                        chunk.release()
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            self.hashed += 1
+        return digest.digest()
+
+    def _refine(self, executor, groups, partial):
+        """Split each group of paths in `groups` by their hash."""
+        # Hash the files of all groups at once so that the threads are
+        # kept busy when groups are small.
+        hashes = executor.map(functools.partial(self._hash, partial=partial), itertools.chain.from_iterable(groups))
+        refined = []
+        for group in groups:
+            by_hash = find_duplicates_by_key(zip(itertools.islice(hashes, len(group)), group),
+                                             key=lambda pair: pair[0])
+            refined.extend([path for _, path in pairs] for digest, pairs in by_hash.items() if digest is not None)
+        return refined
+
+    def find(self, root):
+        """Return a list of the groups of duplicate files below `root`.
+
+        Each group is a sorted list of full paths, and groups are sorted
+        by their first path.
+
+        """
+        with self._lock:
+            self.files = self.candidates = self.hashed = self.bytes_read = 0
+            self._start_time = time.monotonic()
+            self._end_time = None
+        sizes = []
+        for path, entry in file_list(root, full_path=True, threads=self.threads, entries=True):
+            try:
+                sizes.append((entry.stat().st_size, path))
+            except OSError:
+                continue
+            self.files += 1
+
+        by_size = find_duplicates_by_key(sizes, key=lambda pair: pair[0])
+        self.candidates = sum(map(len, by_size.values()))
+        duplicates = []
+        partial_groups = []
+        full_groups = []
+        for size, pairs in by_size.items():
+            paths = [path for _, path in pairs]
+            if size == 0:
+                duplicates.append(paths)
+            elif size <= 2 * self.block_size:
+                full_groups.append(paths)
+            else:
+                partial_groups.append(paths)
+
+        with futures.ThreadPoolExecutor(self.threads) as executor:
+            # Files no bigger than two blocks are hashed in full straight
+            # away, as a partial hash would read the whole file anyway.
+            full_groups.extend(self._refine(executor, partial_groups, True))
+            duplicates.extend(self._refine(executor, full_groups, False))
+
+        self._end_time = time.monotonic()
+        for group in duplicates:
+            group.sort()
+        duplicates.sort()
+        return duplicates